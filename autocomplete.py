@@ -1,16 +1,31 @@
-import nltk.tokenize
-from nltk.corpus import brown
 from collections import defaultdict
 import re
+import math
 from operator import itemgetter
 import argparse
+import cPickle
 import os
 import persist
-from collections import deque
+import frozentrie
+import typoindex
+import ingest
+import buildcache
+import lazytrie
+from keyboard import KeyboardModel
+from itertools import chain, count, islice
+import heapq
 import time
+import multiprocessing
+from array import array
+import gc
+import threading
+from contextlib import contextmanager
 
 
 
+WORD_START = re.compile('[a-zA-Z0-9]') # Short tokens must start with one
+NO_PATH = float('-inf') # Log probability of an impossible spelling
+
 class Trie:
     """
         The Trie class builds and maintains a trie, where each node represents 
@@ -70,21 +85,75 @@ class Trie:
     further_chars['k'] = ['u','o']
     further_chars['l'] = ['i','p']
 
+    TOP_K_CACHE_SIZE = 10 # Number of ranked completions cached on each node
+
+    SAME_LET_PROB_VAL = 0.75 # Probability a typed letter is the one meant
+    NEAR_LET_PROB_VAL = 0.08 # ... that a nearby letter was meant instead
+    FAR_LET_PROB_VAL = 0.03 # ... that a further away letter was meant instead
+    EXTRA_LET_PEN_FACTOR = 10 # Penalty for each letter beyond those typed
+    TYPO_SEARCH_MAX_EXPANSIONS = 20000 # Nodes a typo search may expand
+
+    # Default keyboard model, a different one can be passed to the Trie
+    keyboard = KeyboardModel.from_layout(nearby_chars, further_chars,
+                                         SAME_LET_PROB_VAL, NEAR_LET_PROB_VAL,
+                                         FAR_LET_PROB_VAL)
+
 
-    def __init__(self, vocab):
+    def __init__(self, vocab, cache_size=TOP_K_CACHE_SIZE, keyboard=None):
         """ 
             Initializing function for the trie, creates structure 
-            from given vocabulary dict 
+            from given vocabulary dict.  *cache_size* is the number of most
+            common completions cached on every node (0 disables the cache)
+            and *keyboard* a keyboard.KeyboardModel to use for corrections
         """
-        self.root = Node("", "")
+        if keyboard is not None:
+            self.keyboard = keyboard
+        self.root = Node("")
         self.vocabulary = vocab # should I store this whole thing.?
+        self.cache_size = cache_size
+        self.typo_index = None # Optional typoindex.TypoIndex for corrections
+        self._changes = {} # word -> count change not yet synced to the db
+        self._changes_lock = threading.Lock()
         self.generate_trie()
         self.total_words = len(self.vocabulary)
 
+    @classmethod
+    def build_parallel(cls, vocab, processes=None, 
+                       cache_size=TOP_K_CACHE_SIZE, keyboard=None):
+        """
+            Build the same Trie as Trie(vocab, cache_size, keyboard), up to
+            the order of tied completions, with a pool of *processes* workers
+            (all cores if None).  The vocabulary is split by first character
+            with partition_vocabulary, each worker builds and ranks the
+            subtrees of its shard and sends them back in compact form, and
+            they are joined under one root.  Only the root is ranked here.
+        """
+        trie = cls({}, cache_size, keyboard)
+        trie.vocabulary = vocab
+        trie.total_words = len(vocab)
+        processes = processes or multiprocessing.cpu_count()
+        shards = [(shard, cache_size) for shard in 
+                  partition_vocabulary(vocab, processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for subtrees in pool.imap_unordered(_build_shard, shards):
+                with _gc_paused():
+                    _deserialize_children(trie.root, subtrees)
+        finally:
+            pool.close()
+            pool.join()
+        trie._rank_node(trie.root, "")
+        return trie
+
     def generate_trie(self):
-        """  Adds one word at a time from the vocabulary to the trie  """
-        for word in self.vocabulary:
-            self.add_word(word)
+        """  
+            Adds one word at a time from the vocabulary to the trie, then 
+            caches the most common completions on every node
+        """
+        with _gc_paused():
+            for word in self.vocabulary:
+                self.add_word(word)
+            self.rank_completions()
 
     def add_word(self, word):
         """ 
@@ -93,38 +162,261 @@ class Trie:
             keep track of the number of appearances of a particular word. 
         """
 
+        if not word:
+            return
         curr_node = self.root
-        curr_word = ""
-        word_count = self.vocabulary[word]
         for letter in word:
-            full_word = curr_word + letter
             child_node = curr_node.child(letter)
             if not child_node:
-                child_node = Node(letter, curr_word)
+                child_node = Node(letter)
                 curr_node.add_child(child_node)
-            curr_word = full_word
             curr_node = child_node
-            if full_word == word:
-                child_node.increment_count(word_count)
-                # self.complete_words[full_word] = child_node
+        curr_node.increment_count(self.vocabulary[word])
+
+    def rank_completions(self):
+        """
+            Walk the trie bottom up, caching on each node the *cache_size*
+            most common (word, count) pairs found in its subtree.  Children 
+            are always ranked before their parent, so each node only merges
+            the already ranked lists of its children.
+        """
+        ordered_nodes = []
+        explore = [(self.root, "")]
+        while explore:
+            node, word = explore.pop()
+            ordered_nodes.append((node, word))
+            for letter, child in node.children.iteritems():
+                explore.append((child, word + letter))
+        for node, word in reversed(ordered_nodes):
+            self._rank_node(node, word)
+
+    def _rank_node(self, node, word):
+        """  
+            Rebuild the cached completions of *node*, which spells *word*, 
+            from its children
+        """
+        children = node.children.values()
+        if len(children) == 1 and not node.word_counts:
+            # Chains of single letters share one cached tuple
+            node.top_words = children[0].top_words
+            node.max_count = children[0].max_count
+            return
+        candidates = [child.top_words for child in children]
+        if node.word_counts and self.cache_size:
+            candidates.append([(word, node.word_counts)])
+        node.top_words = tuple(heapq.nlargest(self.cache_size, 
+                                              chain(*candidates),
+                                              key=itemgetter(1)))
+        node.max_count = max([node.word_counts] + 
+                             [child.max_count for child in children])
+
+    def record_selection(self, word, delta=1):
+        """
+            Count *word* as seen *delta* more times (fewer if negative), 
+            adding it to the trie if it is new.  Only the cached completions
+            on the path from the root to the word are repaired, so the cost is
+            O(depth * k) rather than a rebuild of the trie.  The change is
+            tracked until taken by take_changes.
+        """
+        if not word:
+            return
+        path = [self.root]
+        for letter in word:
+            child_node = path[-1].child(letter)
+            if not child_node:
+                child_node = Node(letter)
+                path[-1].add_child(child_node)
+            path.append(child_node)
+        word_node = path[-1]
+        old_count = word_node.word_counts
+        new_count = max(0, old_count + delta)
+        word_node.word_counts = new_count
+        if new_count:
+            self.vocabulary[word] = new_count
+        else:
+            self.vocabulary.pop(word, None)
+        if new_count and not old_count:
+            self.total_words += 1
+        elif old_count and not new_count:
+            self.total_words -= 1
+        if new_count != old_count:
+            self.restore_changes({word: new_count - old_count})
+        for depth in xrange(len(path)-1, -1, -1): # Children before parents
+            self._rerank_node(path[depth], word[:depth], word, old_count, 
+                              new_count)
+
+    def take_changes(self):
+        """
+            Return the count changes made by record_selection since the last
+            call, as a dict mapping words to how much their counts changed,
+            and start tracking anew.  Safe to call from another thread, see
+            persist.TrieStore.sync_trie
+        """
+        with self._changes_lock:
+            changes, self._changes = self._changes, {}
+        return changes
+
+    def restore_changes(self, changes):
+        """  Add *changes* to those take_changes will return next  """
+        with self._changes_lock:
+            for word, delta in changes.iteritems():
+                delta += self._changes.get(word, 0)
+                if delta:
+                    self._changes[word] = delta
+                else:
+                    self._changes.pop(word, None)
+
+    def _rerank_node(self, node, node_word, word, old_count, new_count):
+        """
+            Repair the cached completions of *node*, spelling *node_word*, 
+            after the count of *word* below it went from *old_count* to 
+            *new_count*.  Expects the children of *node* to be repaired already
+        """
+        ranked_words = [pair for pair in node.top_words if pair[0] != word]
+        was_ranked = len(ranked_words) < len(node.top_words)
+        if new_count < old_count and was_ranked and \
+                len(node.top_words) == self.cache_size:
+            # A word that didn't make the cut before may now belong in it
+            self._rank_node(node, node_word)
+            return
+        if new_count and self.cache_size:
+            ranked_words.append((word, new_count))
+            ranked_words.sort(key=lambda x: -x[1])
+        node.top_words = tuple(ranked_words[:self.cache_size])
+        if new_count >= node.max_count:
+            node.max_count = new_count
+        elif old_count == node.max_count:
+            node.max_count = max([node.word_counts] + 
+                                 [child.max_count 
+                                  for child in node.children.itervalues()])
+
+    def top_k(self, prefix, k=5):
+        """
+            Return the *k* most common (word, count) pairs starting with 
+            *prefix*, from most to least common.  Answered from the cache on 
+            the prefix node when *k* fits in it, so the cost only depends on 
+            the length of *prefix*
+        """
+        node = self.find_node(prefix)
+        if not node:
+            return []
+        if k <= self.cache_size:
+            return list(node.top_words[:k])
+        return list(islice(self._completions_from_node(node, prefix), k))
+
+    def iter_completions(self, prefix):
+        """
+            Lazily yield the (word, count) pairs starting with *prefix* from
+            most to least common.  Stop consuming as soon as enough words have
+            been seen; nodes below the last word taken are never visited.
+        """
+        node = self.find_node(prefix)
+        if not node:
+            return iter([])
+        return self._completions_from_node(node, prefix)
+
+    def complete_many(self, prefixes, k=5, processes=None):
+        """
+            Return the top_k completions of each prefix in *prefixes*, in the
+            same order.  The prefixes are sorted so that neighbours share a
+            path from the root, which is only walked once.  *k* of None gives
+            every completion.  With *processes*, the sorted prefixes are split
+            into that many contiguous chunks answered by a pool of forked 
+            workers, for large batches.
+        """
+        prefixes = list(prefixes)
+        unique_prefixes = sorted(set(prefixes))
+        if processes and processes > 1 and len(unique_prefixes) > 1:
+            global _pool_trie
+            _pool_trie = self # Inherited by the forked workers
+            chunk_size = -(-len(unique_prefixes) // processes)
+            chunks = [(unique_prefixes[i:i+chunk_size], k) for i in 
+                      xrange(0, len(unique_prefixes), chunk_size)]
+            pool = multiprocessing.Pool(processes)
+            try:
+                completions = list(chain.from_iterable(
+                    pool.map(_complete_sorted_chunk, chunks)))
+            finally:
+                pool.close()
+                pool.join()
+                _pool_trie = None
+        else:
+            completions = self._complete_sorted(unique_prefixes, k)
+        if prefixes == unique_prefixes:
+            return completions
+        by_prefix = dict(zip(unique_prefixes, completions))
+        return [by_prefix[prefix] for prefix in prefixes]
+
+    def _complete_sorted(self, prefixes, k):
+        """
+            Completions of each of the sorted *prefixes*.  The nodes along the
+            previous prefix are kept on a stack, so each prefix only descends
+            from where it stops sharing letters with the one before it.
+        """
+        path = [self.root] # path[i] is the node spelling prefix[:i]
+        previous = ""
+        completions = []
+        for prefix in prefixes:
+            if not prefix.startswith(previous):
+                del path[len(os.path.commonprefix((prefix, previous)))+1:]
+            node = path[-1]
+            for letter in prefix[len(path)-1:]:
+                node = node and node.children.get(letter)
+                path.append(node)
+            previous = prefix
+            if not node:
+                completions.append([])
+            elif k is not None and k <= self.cache_size:
+                completions.append(list(node.top_words[:k]))
+            else:
+                completions.append(list(islice(
+                    self._completions_from_node(node, prefix), k)))
+        return completions
+
+    def _completions_from_node(self, node, word):
+        """
+            Best-first search under *node*, which spells *word*.  Subtrees are
+            queued by the largest count found in them and words by their own
+            count, so a word is only yielded once nothing left in the queue 
+            can beat it.
+        """
+        tiebreak = count() # Keeps the heap from ever comparing nodes
+        queue = [(-node.max_count, next(tiebreak), word, node)]
+        while queue:
+            neg_count, _, word, node = heapq.heappop(queue)
+            if node is None:
+                yield (word, -neg_count)
+                continue
+            if node.word_counts:
+                heapq.heappush(queue, (-node.word_counts, next(tiebreak), 
+                                       word, None))
+            for letter, child in node.children.iteritems():
+                if child.max_count:
+                    heapq.heappush(queue, (-child.max_count, next(tiebreak), 
+                                           word + letter, child))
 
     def all_words_with_prefix(self, string):
         """  returns all words that start with a prefix given by 'string'  """
-        return self.words_from_node(self.find_node(string))
+        return self.words_from_node(self.find_node(string), string)
          
 
-    def words_from_node(self, node):
+    def words_from_node(self, node, prefix=""):
         """ 
-            Recursively traverse through the tree from a given starting node,
-            searching for all valid words and returning them in a list 
+            Traverse through the tree from a given starting node, spelling 
+            *prefix*, searching for all valid words and returning them in a 
+            list.  Uses an explicit stack so long words can't hit the 
+            recursion limit
         """
         if not node:
             return []
         prefixed_words = []
-        if node.word_counts:
-            prefixed_words.append([node.word, node.word_counts])
-        for child in node.children:
-            prefixed_words.extend(self.words_from_node(child))
+        explore = [(node, prefix)]
+        while explore:
+            node, word = explore.pop()
+            if node.word_counts:
+                prefixed_words.append([word, node.word_counts])
+            for letter, child in node.children.iteritems():
+                explore.append((child, word + letter))
         return prefixed_words
 
     def find_node(self, string):
@@ -133,171 +425,565 @@ class Trie:
             belonging to the string, which represents the string itself
         """
         curr_node = self.root
-        curr_word = ""
         for letter in string:
-            full_word = curr_word + letter
-            child_node = curr_node.child(letter)
-            if child_node:
-                curr_node = child_node
-            else:
+            curr_node = curr_node.child(letter)
+            if not curr_node:
                 return None
-            curr_word = full_word
         return curr_node
 
-    def _print_trie_helper(self, curr_node):
-        if curr_node.word_counts:
-            print curr_node.word, curr_node.word_counts
-        for child in curr_node.children:
-            self.print_trie_helper(child)
+    def cursor(self, prefix=""):
+        """
+            Return a PrefixCursor positioned at *prefix*, for following what
+            a user types one keystroke at a time
+        """
+        prefix_cursor = PrefixCursor(self)
+        for letter in prefix:
+            prefix_cursor.advance(letter)
+        return prefix_cursor
+
+    def freeze(self, path):
+        """
+            Write a read-only snapshot of the trie, including the cached
+            completions, to *path*.  Load it with frozentrie.FrozenTrie.open
+        """
+        frozentrie.freeze(self, path)
 
     def _print_trie(self):
         """  Print out each word on the trie. Used for testing  """
-        self._print_trie_helper(self.root)
+        for word, word_counts in self.words_from_node(self.root):
+            print word, word_counts
 
-    def create_from_db(self):
+    def create_from_db(self, chunk_size=None):
         """
             Create the Trie structure from a representation of a Trie stored in a
             database.  Each node in the database is stored as a tuple of
             (id, p_id, let, count, word)
-            Void function
+            The whole table is read in one ordered scan, *chunk_size* rows at a
+            time (persist.FETCH_CHUNK_SIZE if None), and nodes are linked to
+            their parents through an id -> node map.  Returns a dict with the
+            number of 'nodes' and 'words' loaded, the 'db_time' spent waiting
+            on the database and the 'total_time'
         """
 
         if self.root.children:
             print "Error: create_from_db given non-empty Trie"
             return None
-        db_access_time = 0
         total_time_start = time.time()
-        from persist import SQL_Vars
+        db_access_time = 0
         conn = persist.db_connect()
         cursor = conn.cursor()
-        start = time.time()
-        sql_node = persist.get_root(cursor)
-        db_access_time += time.time()-start
-        explore = deque([(sql_node, self.root)])
-        while explore:
-            sql_node, trie_node = explore.pop()
+        nodes = {} # id -> Node of every node seen so far
+        orphans = defaultdict(list) # p_id -> nodes read before their parent
+        num_nodes = 0
+        chunks = persist.iter_node_chunks(cursor, 
+                                          chunk_size or persist.FETCH_CHUNK_SIZE)
+        while True:
             start = time.time()
-            if sql_node[SQL_Vars.count]:
-                self.total_words += 1
-            sql_children = persist.find_children(cursor, sql_node[SQL_Vars.id])
-            finish = time.time()
-            db_access_time += finish-start
-            children_trie_nodes = []
-            for child_sql_node in sql_children:
-                child_trie_node = Node(child_sql_node[SQL_Vars.let], 
-                                       sql_node[SQL_Vars.word], 
-                                       child_sql_node[SQL_Vars.count])
-                children_trie_nodes.append(child_trie_node)
-                explore.appendleft((child_sql_node, child_trie_node))
-            trie_node.add_children(children_trie_nodes)
-        conn.close()
-        print "Total time used for func:", time.time()-total_time_start
-        print "Total time accessing db to find children:", db_access_time
-
-    def _same_len_word_probs(self, word):
-        """
-            Return [word, prob] pairs of the probability of spelling *word*
-            slightly wrong, exploring all nearby words that have the same
-            number of letters as *word*
-        """
-
-        SAME_LET_PROB_VAL = 0.75
-        NEAR_LET_PROB_VAL = 0.08
-        FAR_LET_PROB_VAL = 0.03
-
-        nearby_sequences = [[word[0], SAME_LET_PROB_VAL]]
-        for near_char in self.nearby_chars[word[0]]:
-            nearby_sequences.append([near_char, NEAR_LET_PROB_VAL]) # TODO: Remove hard code
-        for far_char in self.further_chars[word[0]]:
-            nearby_sequences.append([far_char, FAR_LET_PROB_VAL])
-        for letter in word[1:]:
-            new_sequences = []
-            for seq in nearby_sequences:
-                new_sequences.append([seq[0]+letter, seq[1]*SAME_LET_PROB_VAL])
-                if letter in self.nearby_chars:
-                    for near_let in self.nearby_chars[letter]:
-                        new_sequences.append([seq[0]+near_let, seq[1]*NEAR_LET_PROB_VAL])
-                if letter in self.further_chars:
-                    for far_let in self.further_chars[letter]:
-                        new_sequences.append([seq[0]+far_let, seq[1]*FAR_LET_PROB_VAL])
-            nearby_sequences = new_sequences
-        return nearby_sequences
-
-    def _all_related_word_probs(self, same_len_seqs_probs):
-        """
-            Given a list of [word, prob] pairs, explores and finds the probability
-            of other words that use any of the words in the given list as a root.
-            Returns a list of [word, prob] pairs of words from the original list
-            and any new found words.
-        """
-
-        EXTRA_LET_PEN_FACTOR = 10
-
-        all_related_sequences = []
-        word_len = len(same_len_seqs_probs[0])
-        for seq in same_len_seqs_probs:
-            found_words = self.all_words_with_prefix(seq[0])
-            for found_word, word_count in found_words:
-                if found_word == seq[0]:
-                    all_related_sequences.append(seq)
+            chunk = next(chunks, None)
+            db_access_time += time.time()-start
+            if chunk is None:
+                break
+            for node_id, p_id, let, word_count in chunk:
+                if p_id is None:
+                    trie_node = self.root
                 else:
-                    extra_lets = len(found_word)-word_len
-                    all_related_sequences.append([found_word, 
-                                                  seq[1]*(EXTRA_LET_PEN_FACTOR**-extra_lets)])
-                all_related_sequences[-1][1] *= (float(word_count)/self.total_words)
-        return all_related_sequences
+                    trie_node = Node(let, word_count)
+                    if word_count:
+                        self.total_words += 1
+                    parent = nodes.get(p_id)
+                    if parent:
+                        parent.add_child(trie_node)
+                    else:
+                        orphans[p_id].append(trie_node)
+                nodes[node_id] = trie_node
+                if node_id in orphans:
+                    trie_node.add_children(orphans.pop(node_id))
+                num_nodes += 1
+        conn.close()
+        self.rank_completions()
+        return {'nodes': num_nodes,
+                'words': self.total_words,
+                'db_time': db_access_time,
+                'total_time': time.time()-total_time_start}
+
+    def _letter_options(self, letter):
+        """
+            Return (letter, prob) pairs of the letters that could have been
+            meant when *letter* was typed, per the keyboard model
+        """
+        return self.keyboard.letter_options(letter)
+
+    def build_typo_index(self, path=None, **kwargs):
+        """
+            Attach a typoindex.TypoIndex to speed up local_word_probs, trading
+            memory for lookups.  Loaded from *path* if it holds an index of
+            this trie built with the same *kwargs*, otherwise built with
+            *kwargs* (see TypoIndex.build) and saved to *path* if given.  The
+            index reflects the counts at the time it was built.
+        """
+        if path and os.path.exists(path):
+            try:
+                index = typoindex.TypoIndex.load(path)
+            except (EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+                index = None # Unreadable or written by an older version
+            if index is not None and index.matches(self, **kwargs):
+                self.typo_index = index
+                return
+        self.typo_index = typoindex.TypoIndex.build(self, **kwargs)
+        if path:
+            self.typo_index.save(path)
+
+    def local_word_probs(self, word, k=5, 
+                         max_expansions=TYPO_SEARCH_MAX_EXPANSIONS):
+        """
+            Find the *k* words most likely meant when *word* was typed, as a
+            list of [word, prob] pairs sorted by probability (all of them if
+            *k* is None).  Each typed letter may have been the letter itself
+            or a letter near it on the keyboard, and any word extending such
+            a spelling is penalized for each extra letter, weighted by how
+            common the word is.
+
+            The trie and the keyboard model are walked together, best-first:
+            only substitutions that are trie edges are ever expanded, and a
+            branch is only expanded while its best possible probability beats
+            the words already found.  At most *max_expansions* nodes are 
+            expanded (None for no limit), bounding the time spent.
 
+            With a typo_index attached, candidates come from a few lookups in
+            the index instead (see build_typo_index).
+        """
+
+        if not word or not re.search('[a-zA-Z]', word[0]) or not self.total_words:
+            return []
+        if self.typo_index is not None and k is not None:
+            return self.typo_index.lookup(word, self.keyboard, k)
+        word_len = len(word)
+        total_words = float(self.total_words)
+        # Best probability the letters from a depth onward can still have
+        best_rest = [self.keyboard.max_prob**(word_len-depth) 
+                     for depth in xrange(word_len+1)]
+        tiebreak = count() # Keeps the heap from ever comparing nodes
+        queue = [(-best_rest[0]*self.root.max_count/total_words, 
+                  next(tiebreak), 1.0, 0, self.root, "")]
+        word_probs = []
+        expansions = 0
+        while queue and (k is None or len(word_probs) < k):
+            neg_bound, _, prob, depth, node, spelling = heapq.heappop(queue)
+            if node is None: # A word, its bound is its probability
+                word_probs.append([spelling, -neg_bound])
+                continue
+            if max_expansions is not None and expansions >= max_expansions:
+                break
+            expansions += 1
+            if depth < word_len: # Still matching the typed letters
+                for letter, letter_prob in self._letter_options(word[depth]):
+                    child_node = node.child(letter)
+                    if child_node and child_node.max_count:
+                        child_prob = prob*letter_prob
+                        heapq.heappush(queue, 
+                            (-child_prob*best_rest[depth+1]*
+                             child_node.max_count/total_words,
+                             next(tiebreak), child_prob, depth+1, child_node,
+                             spelling+letter))
+                continue
+            penalty = float(self.EXTRA_LET_PEN_FACTOR)**(word_len-depth)
+            if node.word_counts:
+                heapq.heappush(queue, 
+                    (-prob*penalty*node.word_counts/total_words, 
+                     next(tiebreak), prob, depth, None, spelling))
+            penalty /= self.EXTRA_LET_PEN_FACTOR
+            for letter, child_node in node.children.iteritems():
+                if child_node.max_count:
+                    heapq.heappush(queue,
+                        (-prob*penalty*child_node.max_count/total_words,
+                         next(tiebreak), prob, depth+1, child_node,
+                         spelling+letter))
+        return word_probs
 
-    def local_word_probs(self, word):
+    def fuzzy_completions(self, word, max_edits=2, k=5,
+                          max_expansions=TYPO_SEARCH_MAX_EXPANSIONS):
         """
-            Generate all words close in spelling to *word* and determine the
-            probabilities of each possibility.  Then return a list sorted by
-            the probability of the word occurring.
+            Find the *k* words most likely meant when *word* was typed, as a
+            list of [word, prob] pairs sorted by probability, allowing up to
+            *max_edits* edits: a mistyped, extra or dropped letter, or two 
+            swapped neighbouring letters.  Like local_word_probs, words that
+            extend a matching spelling are penalized for each extra letter 
+            and weighted by how common they are.
+
+            A bounded-edit automaton over *word* is intersected with the trie
+            in one best-first traversal.  Each node gets a row holding the 
+            best log probability of matching every prefix of *word* with 
+            every number of edits, computed from its parent's row when the 
+            node is first popped, and is dropped once nothing in its row is
+            within *max_edits*.  Edit probabilities come from the keyboard 
+            model.  At most *max_expansions* nodes are expanded (None for no
+            limit), keeping latency predictable as *max_edits* grows.
         """
 
-        if not word or not re.search('[a-zA-Z]', word[0]):
+        if not word or not self.total_words:
             return []
-        nearby_seq_probs = self._same_len_word_probs(word)
-        all_related_seq_probs = self._all_related_word_probs(nearby_seq_probs)
-        all_related_seq_probs.sort(key=lambda x: -x[1])
-        return all_related_seq_probs
+        word_len = len(word)
+        total_words = float(self.total_words)
+        edit_logs = dict((edit, math.log(prob)) 
+                         for edit, prob in self.keyboard.edit_probs.iteritems())
+        typed_logs = [dict((letter, math.log(prob)) for letter, prob in
+                           self.keyboard.letter_options(typed_letter))
+                      for typed_letter in word]
+        # Best log probability each typed letter not yet matched can add
+        best_letter = max(math.log(self.keyboard.max_prob), edit_logs['insert'])
+        extra_letter = -math.log(self.EXTRA_LET_PEN_FACTOR)
 
+        def bound(row, parent_row):
+            """  Best log probability of any spelling that extends *row*  """
+            best = max(max(row[j]) + (word_len-j)*best_letter 
+                       for j in xrange(word_len+1))
+            if parent_row is not None: # Swaps step on from the parent's row
+                best = max([best] + [max(parent_row[j][:-1]) + 
+                                     edit_logs['transpose'] + 
+                                     (word_len-j-2)*best_letter
+                                     for j in xrange(word_len-1)])
+            return best
 
-class Node:
-    """  Class for representing nodes on the trie  """
+        # Nothing meant yet, so any typed letters are insertions
+        root_row = [[NO_PATH]*(max_edits+1) for _ in xrange(word_len+1)]
+        for j in xrange(min(word_len, max_edits)+1):
+            root_row[j][j] = j*edit_logs['insert']
+        root_bound = bound(root_row, None)
 
-    def __init__(self, letter, parent_word, counts=0):
+        tiebreak = count() # Keeps the heap from ever comparing nodes
+        # Entries are (-bound, tiebreak, node, spelling, rows, log prob).
+        # Automaton states carry (row, parent row, whether row is the node's
+        # own or still its parent's) and the log of their bound, completions
+        # of a matched spelling no rows and their log prob, words no node
+        queue = [(-math.exp(root_bound)*self.root.max_count/total_words,
+                  next(tiebreak), self.root, "", (root_row, None, True),
+                  root_bound)]
+        word_probs = []
+        found_words = set()
+        expansions = 0
+        while queue and len(word_probs) < k:
+            neg_bound, _, node, spelling, rows, log_prob = heapq.heappop(queue)
+            if node is None:
+                if spelling not in found_words:
+                    found_words.add(spelling)
+                    word_probs.append([spelling, -neg_bound])
+                continue
+            if max_expansions is not None and expansions >= max_expansions:
+                break
+            expansions += 1
+            if rows is None: # Extending a matched spelling
+                if node.word_counts:
+                    heapq.heappush(queue, 
+                        (-math.exp(log_prob)*node.word_counts/total_words,
+                         next(tiebreak), None, spelling, None, 0))
+                log_prob += extra_letter
+                for letter, child_node in node.children.iteritems():
+                    if child_node.max_count:
+                        heapq.heappush(queue, 
+                            (-math.exp(log_prob)*child_node.max_count/total_words,
+                             next(tiebreak), child_node, spelling+letter, None,
+                             log_prob))
+                continue
+            row, parent_row, evaluated = rows
+            if not evaluated: # Queued under its parent's bound until now
+                parent_row, row = row, self._next_edit_row(
+                    word, typed_logs, edit_logs, row, parent_row, spelling)
+                log_prob = bound(row, parent_row)
+                if log_prob > NO_PATH:
+                    heapq.heappush(queue,
+                        (-math.exp(log_prob)*node.max_count/total_words,
+                         next(tiebreak), node, spelling, 
+                         (row, parent_row, True), log_prob))
+                continue
+            matched = max(row[word_len])
+            if matched > NO_PATH:
+                heapq.heappush(queue,
+                    (-math.exp(matched)*node.max_count/total_words,
+                     next(tiebreak), node, spelling, None, matched))
+            for letter, child_node in node.children.iteritems():
+                if child_node.max_count:
+                    heapq.heappush(queue,
+                        (-math.exp(log_prob)*child_node.max_count/total_words,
+                         next(tiebreak), child_node, spelling+letter, 
+                         (row, parent_row, False), log_prob))
+        return word_probs
+
+    def _next_edit_row(self, word, typed_logs, edit_logs, row, parent_row, 
+                       spelling):
+        """
+            Step the fuzzy_completions automaton from the row of the parent of
+            the node spelling *spelling* to the row of that node.  Entry [j][e]
+            of a row is the best log probability of having typed the first j
+            letters of *word* while meaning the node's spelling, using exactly
+            e edits.  Only the band of j within max_edits of the spelling's 
+            length can be reached.
+        """
+        max_edits = len(row[0])-1
+        depth = len(spelling)
+        letter = spelling[-1]
+        new_row = [[NO_PATH]*(max_edits+1) for _ in xrange(len(word)+1)]
+        if depth <= max_edits: # Meant letters left out
+            for e in xrange(1, max_edits+1):
+                new_row[0][e] = row[0][e-1] + edit_logs['delete']
+        for j in xrange(max(1, depth-max_edits), 
+                        min(len(word), depth+max_edits)+1):
+            typed_letter = word[j-1]
+            letter_log = typed_logs[j-1].get(letter, edit_logs['substitute'])
+            can_swap = (parent_row is not None and j > 1 and 
+                        typed_letter != letter and 
+                        typed_letter == spelling[-2:-1] and 
+                        word[j-2] == letter)
+            diagonal, above, left, cell = row[j-1], row[j], new_row[j-1], \
+                new_row[j]
+            if typed_letter == letter:
+                cell[0] = diagonal[0] + letter_log
+            for e in xrange(1, max_edits+1):
+                best = max(diagonal[e-1 if typed_letter != letter else e] + 
+                           letter_log,
+                           above[e-1] + edit_logs['delete'],
+                           left[e-1] + edit_logs['insert'])
+                if can_swap:
+                    best = max(best, 
+                               parent_row[j-2][e-1] + edit_logs['transpose'])
+                cell[e] = best
+        return new_row
+
+
+class Node(object):
+    """  
+        Class for representing nodes on the trie.  Nodes don't store the word
+        they spell, it is rebuilt from the letters on the path from the root.
+        Slots keep each instance free of a __dict__, and leaves share a single
+        empty children dict until their first child is added.
+    """
+
+    __slots__ = ('children', 'letter', 'word_counts', 'top_words', 'max_count')
+
+    NO_CHILDREN = {} # Shared by all leaves, never mutated
+
+    def __init__(self, letter, counts=0):
         """  
-            Initialization for the Node class requires a letter and a string
-            containing the prior letters in the word the node is representing
+            Initialization for the Node class requires the letter the node 
+            adds to the word spelled by its parent
         """
-        self.children = []
+        self.children = Node.NO_CHILDREN # Mapping of letter to child node
         self.letter = letter
-        self.word = parent_word + letter
         self.word_counts = counts
+        self.top_words = () # Cached most common (word, count) pairs below node
+        self.max_count = counts # Largest word count found below node
     
     def add_children(self, nodes):
         """Add *nodes* (a list of nodes) as children to a node instance"""
-        self.children.extend(nodes)
+        for node in nodes:
+            self.add_child(node)
 
     def add_child(self, node):
         """  Add a node as a child to a node instance  """
-        self.children.append(node)
+        if self.children is Node.NO_CHILDREN:
+            self.children = {}
+        self.children[node.letter] = node
 
     def child(self, letter):
         """  
             Locate the child of a node represented by a particular letter
             or return None of no child exists
         """
-        for child in self.children:
-            if child.letter == letter:
-                return child
-        return None
+        return self.children.get(letter)
 
     def increment_count(self, increment):
         """  Increment the number of appeaances of a node by 'increment'  """
         self.word_counts = self.word_counts + increment
 
+
+class PrefixCursor(object):
+    """
+        Position in a Trie that follows a prefix as it is typed.  The nodes 
+        along the prefix are kept on a stack, so typing or deleting a letter
+        costs one step whatever the length of the prefix.  Once the prefix 
+        leaves the trie, later letters are only counted until they are 
+        deleted again.  Words added to the trie after the prefix left it 
+        aren't seen until the cursor backs up to a live node.
+    """
+
+    def __init__(self, trie):
+        self.trie = trie
+        self._path = [trie.root] # Nodes spelling each live prefix
+        self._letters = []
+        self._dead_letters = 0 # Letters typed since the prefix left the trie
+
+    @property
+    def prefix(self):
+        """  The prefix typed so far  """
+        return ''.join(self._letters)
+
+    @property
+    def node(self):
+        """  Node spelling the prefix, None if no word starts with it  """
+        if self._dead_letters:
+            return None
+        return self._path[-1]
+
+    def advance(self, letter):
+        """  Type *letter*, return False if no word starts with the prefix  """
+        self._letters.append(letter)
+        if not self._dead_letters:
+            child = self._path[-1].children.get(letter)
+            if child is not None:
+                self._path.append(child)
+                return True
+        self._dead_letters += 1
+        return False
+
+    def backspace(self):
+        """  Delete the last letter typed, if there is one  """
+        if not self._letters:
+            return
+        self._letters.pop()
+        if self._dead_letters:
+            self._dead_letters -= 1
+        else:
+            self._path.pop()
+
+    def top_k(self, k=5):
+        """  Trie.top_k for the prefix typed so far  """
+        node = self.node
+        if node is None:
+            return []
+        if k <= self.trie.cache_size:
+            return list(node.top_words[:k])
+        return list(islice(self.trie._completions_from_node(node, self.prefix),
+                           k))
+
+_pool_trie = None # The Trie complete_many workers answer from
+
+def _complete_sorted_chunk(args):
+    """  Worker half of Trie.complete_many: completions for one chunk  """
+    prefixes, k = args
+    return _pool_trie._complete_sorted(prefixes, k)
+
+@contextmanager
+def _gc_paused():
+    """
+        Hold off the cyclic garbage collector while building millions of
+        nodes, which hold no cycles but would make it scan the whole heap
+        again and again
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def partition_vocabulary(vocab, shards):
+    """
+        Split *vocab* into at most *shards* dicts, keeping the words that 
+        start with the same character together so each shard holds whole 
+        subtrees of the root.  Characters are dealt out from the most letters
+        to the least, each to the shard with the fewest letters so far.
+    """
+    by_first = defaultdict(dict)
+    for word, word_count in vocab.iteritems():
+        if word:
+            by_first[word[0]][word] = word_count
+    sizes = sorted((sum(len(word) for word in words), first) 
+                   for first, words in by_first.iteritems())
+    parts = [{} for _ in xrange(shards)]
+    part_sizes = [0] * shards
+    for size, first in reversed(sizes):
+        smallest = part_sizes.index(min(part_sizes))
+        parts[smallest].update(by_first[first])
+        part_sizes[smallest] += size
+    return [part for part in parts if part]
+
+def _build_shard(args):
+    """  Worker half of Trie.build_parallel: build and serialize one shard  """
+    shard, cache_size = args
+    trie = Trie(shard, cache_size)
+    with _gc_paused():
+        return _serialize_children(trie.root)
+
+def _serialize_children(node):
+    """
+        Compact form of the subtrees below *node*.  The letter, word count,
+        largest count below, number of children and number of cached 
+        completions of every node are listed in postorder, and the cached 
+        completions as indexes into a table of (word, count) pairs.  Nodes 
+        that share their only child's cache (see Trie._rank_node) list none
+        and share it again when read back by _deserialize_children.
+    """
+    letters = []
+    word_counts = array('l')
+    max_counts = array('l')
+    num_children = array('I')
+    top_lens = array('I')
+    top_ids = array('I')
+    pair_ids = {}
+    pairs = []
+    explore = [(child, False) for child in node.children.itervalues()]
+    while explore:
+        node, children_done = explore.pop()
+        if node.children and not children_done:
+            explore.append((node, True))
+            explore.extend((child, False) 
+                           for child in node.children.itervalues())
+            continue
+        letters.append(node.letter)
+        word_counts.append(node.word_counts)
+        max_counts.append(node.max_count)
+        num_children.append(len(node.children))
+        if len(node.children) == 1 and not node.word_counts:
+            top_lens.append(0)
+            continue
+        top_lens.append(len(node.top_words))
+        for pair in node.top_words:
+            pair_id = pair_ids.get(pair)
+            if pair_id is None:
+                pair_id = pair_ids[pair] = len(pairs)
+                pairs.append(pair)
+            top_ids.append(pair_id)
+    try:
+        letters = ''.join(letters)
+    except UnicodeDecodeError: # Mixed byte and unicode letters stay a list
+        pass
+    return (letters, word_counts, max_counts, num_children, top_lens, top_ids,
+            pairs)
+
+def _deserialize_children(root, subtrees):
+    """
+        Add the subtrees serialized by _serialize_children to the children
+        of *root*, with their cached completions
+    """
+    letters, word_counts, max_counts, num_children, top_lens, top_ids, \
+        pairs = subtrees
+    built = [] # Subtrees waiting for their parent, which comes after them
+    top_start = 0
+    for i in xrange(len(word_counts)):
+        node = Node(letters[i], word_counts[i])
+        node.max_count = max_counts[i]
+        if num_children[i] == 1:
+            child = built.pop()
+            node.children = {child.letter: child}
+            if not node.word_counts:
+                node.top_words = child.top_words
+                built.append(node)
+                continue
+        elif num_children[i]:
+            node.children = dict((child.letter, child) 
+                                 for child in built[-num_children[i]:])
+            del built[-num_children[i]:]
+        top_len = top_lens[i]
+        if top_len == 1: # Most nodes are leaves caching only their own word
+            node.top_words = (pairs[top_ids[top_start]],)
+        elif top_len:
+            node.top_words = tuple([pairs[j] for j in 
+                                    top_ids[top_start:top_start+top_len]])
+        top_start += top_len
+        built.append(node)
+    for node in built:
+        root.add_child(node)
+
 def generate_vocabulary(corpus):
     """  
         Given any python iterable (that contains a representation of words or
@@ -306,11 +992,23 @@ def generate_vocabulary(corpus):
     """
     vocab = defaultdict(int)
     for word in corpus:
-        if len(word) > 2 or re.search('[a-zA-Z0-9]', word[0]):
+        if len(word) > 2 or WORD_START.match(word[0]):
             word = word.lower()
             vocab[word] += 1
     return vocab
 
+def load_vocabulary(data=None, num_sentences=50000, processes=None):
+    """
+        Vocabulary of the file *data*, counted by *processes* workers, of the
+        text *data* if there is no such file, or of the first *num_sentences*
+        sentences of the Brown corpus if *data* isn't given
+    """
+    if not data:
+        return generate_vocabulary(ingest.brown_words(num_sentences))
+    if os.path.exists(data): # Stream and count the file in chunks
+        return ingest.file_vocabulary([data], processes)
+    return ingest.count_text(data)
+
 def store_trie(trie):
     """
         Store the representation *trie*, an instance of class Trie, in the db
@@ -334,16 +1032,16 @@ def run_interpreter(trie):
             return
         os.system('clear')
         s = time.time()
-        ret_list = trie.all_words_with_prefix(inp.lower())
+        ret_list = trie.top_k(inp.lower(), 5) # Sorted from greatest to least
         print "Search time:", time.time() - s
-        ret_list.sort(key=lambda x: -x[1]) # Sort from greatest to least
         num_to_print = min(5, len(ret_list))
         if num_to_print == 0:
             print "No words were found..."
         for i in xrange(num_to_print):
             print str(i+1)+'. ' + str(ret_list[i][0]) + ' - ' + str(ret_list[i][1])
-        nearby_words = trie.local_word_probs(inp.lower())
-        nearby_words.sort(key=lambda x: -x[1])
+        if not hasattr(trie, 'local_word_probs'): # Frozen tries only complete
+            continue
+        nearby_words = trie.local_word_probs(inp.lower(), 5)
         num_to_print = min(5, len(nearby_words))
         print "\nProbability of attempt at spelling particular word"
         for i in xrange(num_to_print):
@@ -361,11 +1059,9 @@ def create_trie(training_data=""):
     if training_data:
         if type(training_data) != str:
             training_data = " ".join(training_data)
-        training_set = nltk.tokenize.word_tokenize(training_data)
+        vocabulary = ingest.count_text(training_data)
     else:
-        training_set = brown.sents()[:50000]
-        training_set = [word for sentence in training_set for word in sentence]
-    vocabulary = generate_vocabulary(training_set)
+        vocabulary = generate_vocabulary(ingest.brown_words(50000))
     T = Trie(vocabulary)
     return T
 
@@ -379,26 +1075,54 @@ def main():
     parser = argparse.ArgumentParser(description="Give the most common word given a prefix")
     parser.add_argument("data", nargs="?")
     parser.add_argument("-db", action="store_true")
+    parser.add_argument("-db_path", default=persist.DB_PATH)
+    parser.add_argument("-lazy", action="store_true") # Load db nodes on demand
+    parser.add_argument("-max_nodes", type=int, default=lazytrie.MAX_NODES)
+    parser.add_argument("-freeze", metavar="PATH") # Snapshot the built trie
+    parser.add_argument("-frozen", metavar="PATH") # Serve from a snapshot
+    parser.add_argument("-typo_index", metavar="PATH") # Load or build and save
+    parser.add_argument("-keyboard", metavar="PATH") # JSON keyboard model
+    parser.add_argument("-processes", type=int) # Workers counting and building
+    parser.add_argument("-build_cache", default=buildcache.CACHE_DIR)
+    parser.add_argument("-no_build_cache", action="store_true") # Always rebuild
     args = parser.parse_args()
 
     print "Loading..."
+    keyboard = KeyboardModel.load(args.keyboard) if args.keyboard else None
+    if args.frozen:
+        T = frozentrie.FrozenTrie.open(args.frozen)
+        run_interpreter(T)
+        T.close()
+        return
+    if args.db and args.lazy:
+        persist.set_db_path(args.db_path)
+        run_interpreter(lazytrie.LazyTrie(max_nodes=args.max_nodes))
+        return
     if args.db:
-        T = Trie({})
+        persist.set_db_path(args.db_path)
+        T = Trie({}, keyboard=keyboard)
         T.create_from_db()
+        if args.freeze:
+            T.freeze(args.freeze)
+        if args.typo_index:
+            T.build_typo_index(args.typo_index)
         run_interpreter(T)
         return
 
-    if not args.data:
-        training_set = brown.sents()[:50000]
-        training_set = [word for sentence in training_set for word in sentence]
-    else: # Want to read from a file or string
-        if os.path.exists(args.data):
-            with open(args.data, "r") as f:
-                training_set = nltk.tokenize.word_tokenize(f.read())
-        else:
-            training_set = nltk.tokenize.word_tokenize(args.data)
-    vocabulary = generate_vocabulary(training_set)
-    T = Trie(vocabulary)
+    if not args.no_build_cache:
+        T = buildcache.cached_trie(args.data, 50000, args.build_cache, keyboard,
+                                   args.processes)
+    elif args.processes > 1:
+        T = Trie.build_parallel(load_vocabulary(args.data, 50000, 
+                                                args.processes),
+                                args.processes, keyboard=keyboard)
+    else:
+        T = Trie(load_vocabulary(args.data, 50000, args.processes), 
+                 keyboard=keyboard)
+    if args.freeze:
+        T.freeze(args.freeze)
+    if args.typo_index:
+        T.build_typo_index(args.typo_index)
     run_interpreter(T)
 
 if __name__ == "__main__":
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import autocomplete
+import ingest
+import persist
+import server
+
+
+class LegacyNode:
+    """
+        The original trie node: children kept in a list that is scanned on
+        every lookup, and the full word stored on every node
+    """
+
+    def __init__(self, letter, parent_word, counts=0):
+        self.children = []
+        self.letter = letter
+        self.word = parent_word + letter
+        self.word_counts = counts
+
+    def add_child(self, node):
+        self.children.append(node)
+
+    def child(self, letter):
+        for child in self.children:
+            if child.letter == letter:
+                return child
+        return None
+
+
+def legacy_trie(vocab):
+    """  Build a trie of LegacyNodes the way Trie.add_word used to  """
+    root = LegacyNode("", "")
+    for word in vocab:
+        curr_node = root
+        curr_word = ""
+        for letter in word:
+            full_word = curr_word + letter
+            child_node = curr_node.child(letter)
+            if not child_node:
+                child_node = LegacyNode(letter, curr_word)
+                curr_node.add_child(child_node)
+            curr_word = full_word
+            curr_node = child_node
+            if full_word == word:
+                child_node.word_counts += vocab[word]
+    return root
+
+def legacy_find_node(root, string):
+    """  Locate the node spelling *string* in a trie of LegacyNodes  """
+    curr_node = root
+    for letter in string:
+        curr_node = curr_node.child(letter)
+        if not curr_node:
+            return None
+    return curr_node
+
+def legacy_size(root):
+    """  Bytes used by a trie of LegacyNodes, including words and lists  """
+    total = 0
+    explore = [root]
+    while explore:
+        node = explore.pop()
+        total += (sys.getsizeof(node) + sys.getsizeof(node.__dict__) +
+                  sys.getsizeof(node.children) + sys.getsizeof(node.word))
+        explore.extend(node.children)
+    return total
+
+def trie_size(trie):
+    """  Bytes used by the nodes of *trie*, including children and caches  """
+    total = 0
+    counted_caches = set() # Single letter chains share their cached tuple
+    explore = [trie.root]
+    while explore:
+        node = explore.pop()
+        total += sys.getsizeof(node)
+        if node.children is not autocomplete.Node.NO_CHILDREN:
+            total += sys.getsizeof(node.children)
+        if id(node.top_words) not in counted_caches:
+            counted_caches.add(id(node.top_words))
+            total += sys.getsizeof(node.top_words)
+        explore.extend(node.children.itervalues())
+    return total
+
+def count_nodes(trie):
+    """  Number of nodes in *trie*  """
+    total = 0
+    explore = [trie.root]
+    while explore:
+        node = explore.pop()
+        total += 1
+        explore.extend(node.children.itervalues())
+    return total
+
+def load_vocabulary(data=None, num_sentences=50000):
+    """
+        Vocabulary used by the benchmarks: the first *num_sentences* sentences
+        of the Brown corpus, or the words in the file *data*
+    """
+    if data:
+        return ingest.file_vocabulary([data])
+    return autocomplete.generate_vocabulary(ingest.brown_words(num_sentences))
+
+def _timed(fxn, *args):
+    """  Return the result of calling *fxn* and the seconds it took  """
+    start = time.time()
+    result = fxn(*args)
+    return result, time.time() - start
+
+def bench_nodes(vocab):
+    """
+        Compare memory use, build time and lookup latency of the compact Node
+        against the original list-scanning, word-storing node
+    """
+    words = list(vocab)
+    legacy_root, legacy_build = _timed(legacy_trie, vocab)
+    compact, compact_build = _timed(autocomplete.Trie, vocab, 0)
+    cached, cached_build = _timed(autocomplete.Trie, vocab)
+
+    def lookups(find, root):
+        for word in words:
+            find(root, word)
+    _, legacy_lookup = _timed(lookups, legacy_find_node, legacy_root)
+    _, compact_lookup = _timed(lookups, autocomplete.Trie.find_node, compact)
+
+    word_bytes = sum(sys.getsizeof(word) for word in words)
+    print "Vocabulary: %d words, %d nodes, %.1f MB of word strings" % (
+        len(words), count_nodes(compact), word_bytes / 1e6)
+    print "%-22s %10s %10s %14s" % ("", "nodes MB", "build s", "lookup us/word")
+    rows = [("legacy Node", legacy_size(legacy_root), legacy_build,
+             legacy_lookup),
+            ("compact Node", trie_size(compact), compact_build,
+             compact_lookup),
+            ("compact Node + top-%d" % cached.cache_size, trie_size(cached),
+             cached_build, compact_lookup)]
+    for name, size, build, lookup in rows:
+        print "%-22s %10.1f %10.2f %14.2f" % (name, size / 1e6, build,
+                                              lookup * 1e6 / len(words))
+
+def _stored_words(store):
+    """  Sorted (word, count) pairs persisted in *store*  """
+    cursor = store.connection().cursor()
+    cursor.execute("""SELECT word, count FROM Trie WHERE count > 0""")
+    return sorted(cursor.fetchall())
+
+def bench_persist(vocab):
+    """
+        Compare loading *vocab* into an empty database one word at a time,
+        the way persist.add_words used to, against the bulk loader
+    """
+    def per_word(store):
+        conn = store.connection()
+        cursor = conn.cursor()
+        persist.create_table(cursor)
+        for word in vocab:
+            persist._add_word(cursor, word, vocab[word])
+        conn.commit()
+
+    tmp_dir = tempfile.mkdtemp()
+    per_word_store = persist.TrieStore(os.path.join(tmp_dir, 'per_word.db'))
+    bulk_store = persist.TrieStore(os.path.join(tmp_dir, 'bulk.db'))
+    try:
+        _, per_word_time = _timed(per_word, per_word_store)
+        _, bulk_time = _timed(bulk_store.add_vocabulary, vocab)
+        if _stored_words(bulk_store) != _stored_words(per_word_store):
+            print "Bulk loaded words differ from the per word load!"
+    finally:
+        per_word_store.close()
+        bulk_store.close()
+        shutil.rmtree(tmp_dir)
+
+    print "Vocabulary: %d words" % len(vocab)
+    print "%-22s %10s" % ("", "load s")
+    print "%-22s %10.2f" % ("per word _add_word", per_word_time)
+    print "%-22s %10.2f" % ("add_vocabulary", bulk_time)
+
+def _sample_words(vocab, num_words, seed=0):
+    """  *num_words* words drawn from *vocab* by how often they were seen  """
+    words = list(vocab)
+    totals = []
+    total = 0
+    for word in words:
+        total += vocab[word]
+        totals.append(total)
+    rand = random.Random(seed)
+    return [words[bisect.bisect(totals, rand.random() * total)]
+            for _ in xrange(num_words)]
+
+def _keystrokes(vocab, num_words, seed=0):
+    """
+        Prefixes typed entering *num_words* words drawn from *vocab* by how
+        often they were seen, one prefix per letter
+    """
+    return [word[:i] for word in _sample_words(vocab, num_words, seed)
+            for i in xrange(1, len(word)+1)]
+
+def bench_results(vocab, k=5, num_words=5000, update_every=100):
+    """
+        Compare most_common_words with and without its result cache on the
+        keystrokes of *num_words* words drawn by frequency, adding the typed
+        word to the database after every *update_every* of them
+    """
+    prefixes = _keystrokes(vocab, num_words)
+    tmp_dir = tempfile.mkdtemp()
+    cached = persist.TrieStore(os.path.join(tmp_dir, 'cached.db'))
+    uncached = persist.TrieStore(os.path.join(tmp_dir, 'uncached.db'),
+                                 result_cache_size=0)
+    try:
+        cached.add_vocabulary(vocab)
+        uncached.add_vocabulary(vocab)
+
+        def typing(store):
+            results = []
+            for i, prefix in enumerate(prefixes):
+                results.append(store.most_common_words(prefix, k))
+                if i % update_every == update_every - 1:
+                    store.add_word(prefix)
+            return results
+        expected, uncached_time = _timed(typing, uncached)
+        results, cached_time = _timed(typing, cached)
+        if results != expected:
+            print "Cached completions differ from the database!"
+        cache = cached.result_cache
+    finally:
+        cached.close()
+        uncached.close()
+        shutil.rmtree(tmp_dir)
+
+    print "Queries: %d (%d distinct), updates: %d" % (
+        len(prefixes), len(set(prefixes)), len(prefixes) // update_every)
+    print "Cache: %d entries, %d hits, %d misses (%.1f%% hit rate)" % (
+        len(cache), cache.hits, cache.misses, 
+        100.0 * cache.hits / max(1, cache.hits + cache.misses))
+    print "%-22s %10s %14s" % ("", "total s", "queries/s")
+    for name, seconds in [("uncached", uncached_time), 
+                          ("ResultCache", cached_time)]:
+        print "%-22s %10.2f %14.0f" % (name, seconds, len(prefixes) / seconds)
+
+def bench_writes(vocab, num_words=5000):
+    """
+        Compare adding *num_words* words drawn by frequency to a database
+        holding *vocab* with one commit each, through TrieStore.add_word,
+        against queueing them on a WriteBehindQueue and flushing it
+    """
+    words = _sample_words(vocab, num_words)
+    tmp_dir = tempfile.mkdtemp()
+    per_word = persist.TrieStore(os.path.join(tmp_dir, 'per_word.db'))
+    queued = persist.TrieStore(os.path.join(tmp_dir, 'queued.db'))
+    try:
+        per_word.add_vocabulary(vocab)
+        queued.add_vocabulary(vocab)
+
+        def one_at_a_time():
+            for word in words:
+                per_word.add_word(word)
+        _, per_word_time = _timed(one_at_a_time)
+
+        queue = persist.WriteBehindQueue(queued)
+        start = time.time()
+        for word in words:
+            queue.add_word(word)
+        accept_time = time.time() - start
+        queue.flush()
+        queued_time = time.time() - start
+        queue.close()
+        if _stored_words(per_word) != _stored_words(queued):
+            print "Queued counts differ from the per word writes!"
+    finally:
+        per_word.close()
+        queued.close()
+        shutil.rmtree(tmp_dir)
+
+    print "Updates: %d (%d distinct words)" % (len(words), len(set(words)))
+    print "Queue: %d commits, %.1f ms mean and %.1f ms max commit latency" % (
+        queue.commits, queue.mean_commit_latency * 1e3, 
+        queue.max_commit_latency * 1e3)
+    print "%-22s %10s %14s" % ("", "total s", "updates/s")
+    for name, seconds in [("add_word", per_word_time),
+                          ("queue add_word", accept_time),
+                          ("queue + flush", queued_time)]:
+        print "%-22s %10.3f %14.0f" % (name, seconds, 
+                                       len(words) / max(seconds, 1e-6))
+
+def bench_batch(vocab, k=5, processes=(2, 4)):
+    """
+        Compare answering the top-*k* completions of every prefix of every
+        word in *vocab*, as typed letter by letter, one top_k call at a time
+        against Trie.complete_many, serially and split across process pools
+    """
+    trie = autocomplete.Trie(vocab)
+    prefixes = [word[:i] for word in vocab for i in xrange(1, len(word)+1)]
+
+    def one_at_a_time():
+        return [trie.top_k(prefix, k) for prefix in prefixes]
+    expected, loop_time = _timed(one_at_a_time)
+    rows = [("top_k loop", loop_time)]
+    results, batch_time = _timed(trie.complete_many, prefixes, k)
+    rows.append(("complete_many", batch_time))
+    for num_processes in processes:
+        pooled, pool_time = _timed(trie.complete_many, prefixes, k, 
+                                   num_processes)
+        rows.append(("complete_many x%d" % num_processes, pool_time))
+        results = results if pooled == results else None
+    if results != expected:
+        print "Batched completions differ from top_k!"
+
+    print "Prefixes: %d (%d distinct), CPUs: %d" % (
+        len(prefixes), len(set(prefixes)), multiprocessing.cpu_count())
+    print "%-22s %10s %14s" % ("", "total s", "prefixes/s")
+    for name, seconds in rows:
+        print "%-22s %10.2f %14.0f" % (name, seconds, len(prefixes) / seconds)
+
+def _memory_kb(pid):
+    """
+        (proportional set size, private) memory of process *pid* in kB.  The
+        proportional size splits each shared page between its users.
+    """
+    pss = private = 0
+    with open('/proc/%d/smaps' % pid) as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                pss += int(line.split()[1])
+            elif line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                private += int(line.split()[1])
+    return pss, private
+
+def _request_loop(port, prefixes, seconds, answered):
+    """  Client half of bench_prefork: send requests one at a time  """
+    conn = socket.create_connection(('127.0.0.1', port))
+    responses = conn.makefile()
+    requests = [json.dumps({'prefix': prefix}) + '\n' for prefix in prefixes]
+    done = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        conn.sendall(requests[done % len(requests)])
+        responses.readline()
+        done += 1
+    conn.close()
+    answered.put(done)
+
+def bench_prefork(vocab, process_counts=(1, 2, 4), clients=8, seconds=3):
+    """
+        Requests per second and worker memory of server.fork_workers serving
+        a Trie and a FrozenTrie snapshot of it with an increasing number of
+        worker processes, each loaded by *clients* connections for *seconds*
+    """
+    trie = autocomplete.Trie(vocab)
+    prefixes = [word[:i] for word in vocab for i in xrange(1, len(word)+1)]
+    backends = [("Trie", server.TrieBackend(trie)),
+                ("FrozenTrie", server.frozen_backend(trie))]
+    print "CPUs: %d, clients: %d" % (multiprocessing.cpu_count(), clients)
+    print "%-12s %9s %10s %14s %14s" % ("", "processes", "requests/s",
+                                        "PSS MB", "private MB")
+    for name, backend in backends:
+        for num_processes in process_counts:
+            listener = server.listen(port=0)
+            port = listener.getsockname()[1]
+            pids = server.fork_workers(backend, listener, num_processes)
+            listener.close()
+            answered = multiprocessing.Queue()
+            loaders = [multiprocessing.Process(target=_request_loop, args=(
+                           port, prefixes[i::clients], seconds, answered))
+                       for i in xrange(clients)]
+            try:
+                for loader in loaders:
+                    loader.start()
+                requests = sum(answered.get() for _ in loaders)
+                for loader in loaders:
+                    loader.join()
+                memory = [_memory_kb(pid) for pid in pids]
+            finally:
+                server.stop_workers(pids)
+            print "%-12s %9d %10.0f %14.1f %14.1f" % (
+                name, num_processes, requests / float(seconds),
+                sum(pss for pss, _ in memory) / 1e3,
+                sum(private for _, private in memory) / 1e3)
+    backends[1][1].trie.close()
+
+def bench_ingest(vocab, process_counts=(1, 2, 4)):
+    """
+        Compare counting a text file written from *vocab* by tokenizing all
+        of it at once against ingest.file_vocabulary streaming it in chunks
+        to an increasing number of processes
+    """
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'corpus.txt')
+    try:
+        with open(path, 'w') as f:
+            for word in vocab:
+                line = ' '.join([word] * vocab[word]) + '\n'
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+                f.write(line)
+        size = os.path.getsize(path)
+
+        def whole_file():
+            with open(path, 'r') as f:
+                return ingest.count_text(f.read())
+        expected, whole_time = _timed(whole_file)
+        rows = [("whole file", whole_time)]
+        for num_processes in process_counts:
+            counted, seconds = _timed(ingest.file_vocabulary, [path], 
+                                      num_processes)
+            rows.append(("file_vocabulary x%d" % num_processes, seconds))
+            if counted != expected:
+                print "Streamed vocabulary differs from the whole file!"
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print "Corpus: %.1f MB, CPUs: %d" % (size / 1e6, multiprocessing.cpu_count())
+    print "%-22s %10s %10s" % ("", "count s", "MB/s")
+    for name, seconds in rows:
+        print "%-22s %10.2f %10.2f" % (name, seconds, size / 1e6 / seconds)
+
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'ingest': bench_ingest,
+    'nodes': bench_nodes,
+    'persist': bench_persist,
+    'prefork': bench_prefork,
+    'results': bench_results,
+    'writes': bench_writes,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the autocomplete trie")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("data", nargs="?") # Training file, Brown if not given
+    parser.add_argument("-sentences", type=int, default=50000)
+    args = parser.parse_args()
+    if args.data and not os.path.exists(args.data):
+        parser.error("no such file: " + args.data)
+    BENCHMARKS[args.benchmark](load_vocabulary(args.data, args.sentences))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+from array import array
+import autocomplete
+
+CACHE_DIR = '.build_cache'
+FORMAT_VERSION = 1
+# Bump whenever generate_vocabulary or the Trie change what gets built from
+# the same text, so old entries are never loaded
+NORMALIZATION_VERSION = 1
+
+
+def nltk_data_dirs():
+    """
+        Directories nltk looks for its data in, without importing nltk (see
+        nltk.data.path)
+    """
+    dirs = os.environ.get('NLTK_DATA', '').split(os.pathsep)
+    dirs.append(os.path.expanduser('~/nltk_data'))
+    for root in (sys.prefix, '/usr', '/usr/local'):
+        dirs.extend(os.path.join(root, sub) for sub in
+                    ('nltk_data', 'share/nltk_data', 'lib/nltk_data'))
+    return [directory for directory in dirs if directory]
+
+def source_digest(data=None):
+    """
+        Digest of the text a vocabulary is built from: the contents of the
+        file *data*, the string *data* itself, or the names, sizes and
+        modification times of the Brown corpus files if *data* is None.
+        Returns None if the Brown corpus can't be found.
+    """
+    digest = hashlib.sha1()
+    if data and os.path.exists(data):
+        with open(data, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                digest.update(block)
+        return 'file:' + digest.hexdigest()
+    if data:
+        digest.update(data.encode('utf-8') if isinstance(data, unicode)
+                      else data)
+        return 'text:' + digest.hexdigest()
+    for directory in nltk_data_dirs():
+        corpus = os.path.join(directory, 'corpora', 'brown')
+        if os.path.isdir(corpus):
+            for name in sorted(os.listdir(corpus)):
+                stat = os.stat(os.path.join(corpus, name))
+                digest.update('%s %d %d\n' % (name, stat.st_size,
+                                              stat.st_mtime))
+            return 'brown:' + digest.hexdigest()
+        if os.path.isfile(corpus + '.zip'):
+            stat = os.stat(corpus + '.zip')
+            digest.update('%d %d' % (stat.st_size, stat.st_mtime))
+            return 'brown.zip:' + digest.hexdigest()
+    return None
+
+def cache_key(data=None, num_sentences=50000):
+    """
+        Key of the cache entry built from *data* (see source_digest), or None
+        if the source can't be identified.  The sentence limit only matters
+        for the Brown corpus.
+    """
+    source = source_digest(data)
+    if source is None:
+        return None
+    if data:
+        num_sentences = None
+    return hashlib.sha1(repr((NORMALIZATION_VERSION, source, num_sentences,
+                              autocomplete.Trie.TOP_K_CACHE_SIZE))).hexdigest()
+
+def save(path, trie):
+    """
+        Write the vocabulary and nodes of *trie* to *path*, replacing any
+        file already there in one step
+    """
+    letters, word_counts, max_counts, num_children, top_lens, top_ids, pairs = \
+        autocomplete._serialize_children(trie.root)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((FORMAT_VERSION, trie.cache_size,
+                          dict(trie.vocabulary), letters,
+                          word_counts.tostring(), max_counts.tostring(),
+                          num_children.tostring(), top_lens.tostring(),
+                          top_ids.tostring(), pairs), f, 2)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def load(path, keyboard=None):
+    """  Rebuild the Trie written by save to *path*  """
+    with open(path, 'rb') as f:
+        state = marshal.load(f)
+    if state[0] != FORMAT_VERSION:
+        raise ValueError("Unsupported build cache version: %r" % (state[0],))
+    _, cache_size, vocab, letters, word_counts, max_counts, num_children, \
+        top_lens, top_ids, pairs = state
+    trie = autocomplete.Trie({}, cache_size, keyboard)
+    trie.vocabulary = vocab
+    trie.total_words = len(vocab)
+    with autocomplete._gc_paused():
+        autocomplete._deserialize_children(trie.root, (
+            letters, array('l', word_counts), array('l', max_counts),
+            array('I', num_children), array('I', top_lens),
+            array('I', top_ids), pairs))
+    trie._rank_node(trie.root, "")
+    return trie
+
+def cached_trie(data=None, num_sentences=50000, cache_dir=CACHE_DIR,
+                keyboard=None, processes=None):
+    """
+        Trie of the vocabulary of *data*, see autocomplete.load_vocabulary,
+        loaded from *cache_dir* if it was built from the same input before
+        and built and stored there otherwise.  Entries are keyed by
+        cache_key, so changing the text, the sentence limit or the
+        normalization rules builds a new one; a warm start doesn't touch
+        nltk at all.
+    """
+    key = cache_key(data, num_sentences)
+    path = key and os.path.join(cache_dir, key + '.bin')
+    if path and os.path.exists(path):
+        try:
+            return load(path, keyboard)
+        except (EOFError, ValueError, TypeError):
+            pass # Unreadable entry, build it again
+    vocab = autocomplete.load_vocabulary(data, num_sentences, processes)
+    if processes > 1:
+        trie = autocomplete.Trie.build_parallel(vocab, processes,
+                                                keyboard=keyboard)
+    else:
+        trie = autocomplete.Trie(vocab, keyboard=keyboard)
+    if path:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        save(path, trie)
+    return trie
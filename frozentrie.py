@@ -0,0 +1,203 @@
+import heapq
+import mmap
+import struct
+from itertools import count, islice
+
+MAGIC = 'ACTRIE01'
+NO_WORD = 0xFFFFFFFF
+
+# magic, node count, word count, top-k entries, word bytes, cache size, total words
+HEADER = struct.Struct('<8sIIIIII')
+# letter, first child, word count, max count, top-k start, word id,
+# number of children, top-k length
+NODE = struct.Struct('<IIIIIIHH')
+# offset into the word blob, length, count
+WORD = struct.Struct('<III')
+WORD_ID = struct.Struct('<I')
+LETTER = struct.Struct('<I')
+
+
+def freeze(trie, path):
+    """
+        Write *trie*, an instance of class Trie, to *path* in the flat layout
+        read by FrozenTrie.  Nodes are laid out breadth first so the children
+        of a node are contiguous and sorted by letter, and every node's
+        cached top-k list is stored inline as ids into a shared word table.
+    """
+    ordered_nodes = [(trie.root, "", "")]
+    first_children = []
+    i = 0
+    while i < len(ordered_nodes):
+        node, letter, word = ordered_nodes[i]
+        first_children.append(len(ordered_nodes))
+        for letter in sorted(node.children):
+            ordered_nodes.append((node.children[letter], letter, word + letter))
+        i += 1
+
+    word_ids = {}
+    words = []
+    for node, letter, word in ordered_nodes:
+        if node.word_counts:
+            word_ids[word] = len(words)
+            words.append((_encode(word), node.word_counts))
+
+    node_records = []
+    top_ids = []
+    for i, (node, letter, word) in enumerate(ordered_nodes):
+        node_records.append(NODE.pack(ord(letter) if letter else 0,
+                                      first_children[i],
+                                      node.word_counts,
+                                      node.max_count,
+                                      len(top_ids),
+                                      word_ids.get(word, NO_WORD),
+                                      len(node.children),
+                                      len(node.top_words)))
+        top_ids.extend(word_ids[top_word] for top_word, _ in node.top_words)
+
+    word_records = []
+    offset = 0
+    for encoded, word_counts in words:
+        word_records.append(WORD.pack(offset, len(encoded), word_counts))
+        offset += len(encoded)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(node_records), len(words),
+                            len(top_ids), offset, trie.cache_size,
+                            trie.total_words))
+        f.write(''.join(node_records))
+        f.write(''.join(WORD_ID.pack(word_id) for word_id in top_ids))
+        f.write(''.join(word_records))
+        f.write(''.join(encoded for encoded, _ in words))
+
+def _encode(word):
+    """  Words are stored as utf-8 bytes  """
+    if isinstance(word, unicode):
+        return word.encode('utf-8')
+    return word
+
+
+class FrozenTrie(object):
+    """
+        Read-only trie backed by a file written with Trie.freeze.  The file is
+        mmapped and read in place, so opening it costs almost nothing and
+        every process that opens the same file shares its physical pages.
+        Answers the same top_k and iter_completions queries as Trie.
+    """
+
+    def __init__(self, buf, f=None):
+        """  Wrap *buf*, the bytes of a frozen trie, and its open file *f*  """
+        magic, self.node_count, self.word_count, top_entries, word_bytes, \
+            self.cache_size, self.total_words = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a frozen trie file")
+        self._buf = buf
+        self._file = f
+        self._nodes_start = HEADER.size
+        self._top_start = self._nodes_start + self.node_count * NODE.size
+        self._words_start = self._top_start + top_entries * WORD_ID.size
+        self._blob_start = self._words_start + self.word_count * WORD.size
+
+    @classmethod
+    def open(cls, path):
+        """  Map the frozen trie at *path* read-only  """
+        f = open(path, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+        return cls(buf, f)
+
+    def close(self):
+        """  Unmap the file, the FrozenTrie can't be used afterwards  """
+        if self._file:
+            self._buf.close()
+            self._file.close()
+            self._file = None
+
+    def _node(self, index):
+        return NODE.unpack_from(self._buf, self._nodes_start + index * NODE.size)
+
+    def _word(self, word_id):
+        """  Return the (word, count) pair stored under *word_id*  """
+        offset, length, word_counts = WORD.unpack_from(
+            self._buf, self._words_start + word_id * WORD.size)
+        start = self._blob_start + offset
+        return (self._buf[start:start + length], word_counts)
+
+    def find_node(self, string):
+        """
+            Return the index of the node spelling *string*, or None if no word
+            starts with it.  Children are sorted, so each letter is a binary
+            search over the children of the current node.
+        """
+        index = 0
+        for letter in string:
+            letter = ord(letter)
+            _, low, _, _, _, _, num_children, _ = self._node(index)
+            high = low + num_children
+            end = high
+            while low < high:
+                mid = (low + high) // 2
+                if self._letter(mid) < letter:
+                    low = mid + 1
+                else:
+                    high = mid
+            if low == end or self._letter(low) != letter:
+                return None
+            index = low
+        return index
+
+    def _letter(self, index):
+        return LETTER.unpack_from(self._buf, 
+                                  self._nodes_start + index * NODE.size)[0]
+
+    def top_k(self, prefix, k=5):
+        """
+            Return the *k* most common (word, count) pairs starting with 
+            *prefix*, from most to least common
+        """
+        index = self.find_node(prefix)
+        if index is None:
+            return []
+        if k > self.cache_size:
+            return list(islice(self._completions_from_node(index), k))
+        _, _, _, _, top_start, _, _, top_len = self._node(index)
+        start = self._top_start + top_start * WORD_ID.size
+        return [self._word(WORD_ID.unpack_from(self._buf, 
+                                               start + i * WORD_ID.size)[0])
+                for i in xrange(min(k, top_len))]
+
+    def iter_completions(self, prefix):
+        """
+            Lazily yield the (word, count) pairs starting with *prefix* from
+            most to least common
+        """
+        index = self.find_node(prefix)
+        if index is None:
+            return iter([])
+        return self._completions_from_node(index)
+
+    def _completions_from_node(self, index):
+        """
+            Best-first search under the node at *index*, the same search as 
+            Trie.iter_completions but over the flat node records.  Words come
+            from the word table rather than being spelled out along the path.
+        """
+        tiebreak = count()
+        queue = [(-self._node(index)[3], next(tiebreak), index, False)]
+        while queue:
+            neg_count, _, index, is_word = heapq.heappop(queue)
+            if is_word:
+                yield self._word(index)
+                continue
+            _, first_child, word_counts, _, _, word_id, num_children, _ = \
+                self._node(index)
+            if word_counts:
+                heapq.heappush(queue, (-word_counts, next(tiebreak), word_id,
+                                       True))
+            for child in xrange(first_child, first_child + num_children):
+                max_count = self._node(child)[3]
+                if max_count:
+                    heapq.heappush(queue, (-max_count, next(tiebreak), child,
+                                           False))
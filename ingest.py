@@ -0,0 +1,88 @@
+import multiprocessing
+from collections import Counter, deque
+from itertools import islice
+import autocomplete
+
+CHUNK_SIZE = 1 << 22 # Bytes of text tokenized and counted at a time
+CHUNKS_PER_PROCESS = 2 # Chunks waiting on each process, bounding memory use
+
+
+def iter_chunks(paths, chunk_size=CHUNK_SIZE):
+    """
+        Yield the text of the files at *paths* about *chunk_size* bytes at a
+        time.  Chunks end at a line break where there is one, or else at a
+        space, so no token is ever split between two chunks.
+    """
+    for path in paths:
+        with open(path, "r") as f:
+            carry = ""
+            while True:
+                block = f.read(chunk_size)
+                if not block:
+                    break
+                text = carry + block
+                end = text.rfind('\n') + 1 or text.rfind(' ') + 1
+                if not end: # One enormous token, wait for its end
+                    carry = text
+                    continue
+                carry = text[end:]
+                yield text[:end]
+            if carry:
+                yield carry
+
+def count_text(text, tokenize=None):
+    """
+        Counter of the vocabulary of *text*, see generate_vocabulary.  Tokens
+        come from *tokenize*, nltk's word_tokenize if None
+    """
+    if tokenize is None:
+        import nltk.tokenize
+        tokenize = nltk.tokenize.word_tokenize
+    return Counter(autocomplete.generate_vocabulary(tokenize(text)))
+
+def _count_chunk(args):
+    """  Pool half of file_vocabulary  """
+    return count_text(*args)
+
+def file_vocabulary(paths, processes=None, chunk_size=CHUNK_SIZE,
+                    tokenize=None):
+    """
+        Vocabulary of the files at *paths*, counted the way generate_vocabulary
+        counts one list of tokens.  The files are streamed in chunks which
+        are tokenized with *tokenize* (see count_text) and counted by a pool
+        of *processes* (all cores if None), and their Counters merged.  Only
+        a few chunks per process are ever read ahead, so corpora larger than
+        memory can be counted.  *tokenize* must be picklable when using more
+        than one process.
+    """
+    vocab = Counter()
+    chunks = iter_chunks(paths, chunk_size)
+    if processes == 1:
+        for text in chunks:
+            vocab.update(count_text(text, tokenize))
+        return vocab
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        max_pending = CHUNKS_PER_PROCESS * processes
+        pending = deque()
+        for text in chunks:
+            pending.append(pool.apply_async(_count_chunk, ((text, tokenize),)))
+            if len(pending) >= max_pending:
+                vocab.update(pending.popleft().get())
+        while pending:
+            vocab.update(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return vocab
+
+def brown_words(num_sentences=50000):
+    """
+        Lazily yield the words of the first *num_sentences* sentences of the
+        Brown corpus
+    """
+    from nltk.corpus import brown
+    for sentence in islice(brown.sents(), num_sentences):
+        for word in sentence:
+            yield word
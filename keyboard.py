@@ -0,0 +1,161 @@
+import json
+import string
+import numpy as np
+
+ALPHABET = string.ascii_lowercase + string.digits
+
+# Probabilities of the edits that aren't a single mistyped key: a letter typed
+# that wasn't meant, a meant letter left out, two neighbouring letters typed
+# in the wrong order, and any other letter typed in place of the one meant
+DEFAULT_EDIT_PROBS = {'insert': 0.02,
+                      'delete': 0.02,
+                      'transpose': 0.02,
+                      'substitute': 0.005}
+
+# Maps a byte to its index in ALPHABET, or -1 for characters outside of it
+_ALPHABET_INDEX = np.full(256, -1, dtype=np.intp)
+for _i, _char in enumerate(ALPHABET):
+    _ALPHABET_INDEX[ord(_char)] = _i
+
+
+class KeyboardModel(object):
+    """
+        The probability of meaning one key when another was typed, compiled
+        into a matrix of log probabilities indexed by [typed, meant] over
+        ALPHABET.  Characters outside ALPHABET are only ever meant as
+        themselves, with probability *same_prob*.
+
+        Candidate spellings are scored in batches with NumPy: score takes one
+        typed string and many candidates, score_many many of each.  Models
+        can be loaded from a JSON file so other layouts plug in without code
+        changes, see load.
+    """
+
+    def __init__(self, probs, same_prob, edit_probs=None):
+        """
+            *probs* is a len(ALPHABET) x len(ALPHABET) array of probabilities
+            indexed by [typed, meant], *edit_probs* overrides any of the
+            DEFAULT_EDIT_PROBS
+        """
+        probs = np.asarray(probs, dtype=np.float64)
+        if probs.shape != (len(ALPHABET), len(ALPHABET)):
+            raise ValueError("Keyboard matrix must be %dx%d" %
+                             (len(ALPHABET), len(ALPHABET)))
+        self.probs = probs
+        with np.errstate(divide='ignore'):
+            self.log_probs = np.log(probs)
+            self.log_same_prob = np.log(same_prob)
+        self.same_prob = same_prob
+        self.max_prob = max(same_prob, probs.max())
+        self.edit_probs = dict(DEFAULT_EDIT_PROBS)
+        self.edit_probs.update(edit_probs or {})
+        self._options = {} # typed letter -> {meant letter: prob}
+        for typed, row in zip(ALPHABET, probs):
+            self._options[typed] = dict((ALPHABET[meant], float(row[meant]))
+                                        for meant in np.flatnonzero(row))
+
+    @classmethod
+    def from_layout(cls, nearby_chars, further_chars, same_prob, near_prob,
+                    far_prob, edit_probs=None):
+        """
+            Build a model from mappings of each key to the keys near it and
+            further away from it, eg. Trie.nearby_chars and further_chars.
+            A key listed as both near and far counts as near.
+        """
+        probs = np.zeros((len(ALPHABET), len(ALPHABET)))
+        for i, typed in enumerate(ALPHABET):
+            probs[i, i] = same_prob
+            for chars, prob in ((further_chars, far_prob),
+                                (nearby_chars, near_prob)):
+                for meant in chars.get(typed, ()):
+                    probs[i, ALPHABET.index(meant)] = prob
+        return cls(probs, same_prob, edit_probs)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Load a model from the JSON file at *path*.  It either describes a
+            layout, with the keys "nearby" and "further" mapping each key to a
+            list of keys and the probabilities "same", "near" and "far", or
+            holds a full "matrix" of probabilities over ALPHABET, indexed by
+            [typed][meant], and the "same" probability (as written by save).
+            Either may also give an "edits" mapping overriding any of the
+            DEFAULT_EDIT_PROBS
+        """
+        with open(path, 'r') as f:
+            spec = json.load(f)
+        if 'matrix' in spec:
+            return cls(spec['matrix'], spec['same'], spec.get('edits'))
+        return cls.from_layout(spec['nearby'], spec['further'], spec['same'],
+                               spec['near'], spec['far'], spec.get('edits'))
+
+    def save(self, path):
+        """  Write the model to *path* as JSON, readable by load  """
+        with open(path, 'w') as f:
+            json.dump({'same': self.same_prob,
+                       'matrix': self.probs.tolist(),
+                       'edits': self.edit_probs}, f)
+
+    def letter_options(self, letter):
+        """
+            Return (letter, prob) pairs of the letters that could have been
+            meant when *letter* was typed
+        """
+        if letter in self._options:
+            return self._options[letter].items()
+        return [(letter, self.same_prob)]
+
+    def prob(self, typed, meant):
+        """
+            Probability of typing *typed* when meaning *meant*, letter by
+            letter over the common length of the two strings
+        """
+        prob = 1.0
+        for typed_letter, meant_letter in zip(typed, meant):
+            if typed_letter in self._options:
+                prob *= self._options[typed_letter].get(meant_letter, 0)
+            elif typed_letter != meant_letter:
+                return 0.0
+            else:
+                prob *= self.same_prob
+        return prob
+
+    def score(self, typed, candidates):
+        """
+            Return an array with the log probability of each string in
+            *candidates* being meant when *typed* was typed.  Every candidate
+            must be as long as *typed*
+        """
+        return self.score_many([typed], candidates)[0]
+
+    def score_many(self, typed_words, candidates):
+        """
+            Return a len(typed_words) x len(candidates) array of the log
+            probability of each candidate being meant when each typed word
+            was typed.  All strings must have the same length
+        """
+        if not len(candidates) or not len(typed_words) or not typed_words[0]:
+            return np.zeros((len(typed_words), len(candidates)))
+        typed_codes = _encode(typed_words)[:, np.newaxis, :]
+        candidate_codes = _encode(candidates)[np.newaxis, :, :]
+        typed_index = _alphabet_index(typed_codes)
+        candidate_index = _alphabet_index(candidate_codes)
+        in_alphabet = (typed_index >= 0) & (candidate_index >= 0)
+        letter_scores = np.where(
+            in_alphabet,
+            self.log_probs[typed_index.clip(0), candidate_index.clip(0)],
+            np.where(typed_codes == candidate_codes, self.log_same_prob,
+                     -np.inf))
+        return letter_scores.sum(axis=2)
+
+
+def _encode(strings):
+    """  Character codes of equal length *strings* as a 2d array  """
+    if all(isinstance(s, str) for s in strings):
+        return np.frombuffer(''.join(strings), dtype=np.uint8).reshape(
+            len(strings), -1).astype(np.intp)
+    return np.array([[ord(c) for c in s] for s in strings], dtype=np.intp)
+
+def _alphabet_index(codes):
+    """  Index in ALPHABET of each character code, -1 if it isn't there  """
+    return np.where(codes < 256, _ALPHABET_INDEX[codes.clip(0, 255)], -1)
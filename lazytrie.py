@@ -0,0 +1,194 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+import persist
+
+MAX_NODES = 1000000 # Nodes kept in memory, roughly 200 bytes each
+
+
+class LazyNode(object):
+    """
+        Node of a LazyTrie.  Its children and completions are None until
+        first needed, and again once evicted.
+    """
+
+    __slots__ = ('id', 'letter', 'children', 'generation', 'top_words',
+                 'top_generation')
+
+    def __init__(self, node_id, letter):
+        self.id = node_id
+        self.letter = letter
+        self.children = None # Mapping of letter to child node once loaded
+        self.generation = None # Store generation the children were read at
+        self.top_words = None # Most common (word, count) pairs once read
+        self.top_generation = None # Store generation they were read at
+
+
+class LazyTrie(object):
+    """
+        Trie backed by a persist.TrieStore that only holds the nodes queries
+        have reached.  The children of a node are read from the Trie table
+        the first time a prefix passes through it, and its completions from
+        Prefix_Topk the first time they're asked for, so the first query is
+        answered as soon as the root is read, whatever the size of the
+        table, and hot prefixes are answered from memory.
+
+        Once more than *max_nodes* nodes are loaded, the children of the
+        least recently used nodes are dropped, subtrees and all, until it
+        fits again.  A query touches every node on its path from the deepest
+        up, so a node is always evicted before its ancestors and the hot
+        prefixes stay loaded.
+
+        Completions read before a write through the store are read again the
+        next time they're asked for, and so are the children of a node
+        if a letter isn't found among them.  Writes by other processes or
+        other TrieStores over the same database aren't noticed.  Safe to
+        share between threads: the database is read outside of the lock.
+    """
+
+    def __init__(self, store=None, max_nodes=MAX_NODES):
+        self.store = store or persist.default_store()
+        self.max_nodes = max_nodes
+        self.loaded_nodes = 1
+        self.loads = 0 # Times the children of a node were read
+        self.evictions = 0 # Nodes whose children were dropped again
+        self._expanded = OrderedDict() # Nodes with children, LRU first
+        self._lock = threading.Lock() # Guards the nodes and _expanded
+        root = persist.get_root(self.store.connection().cursor())
+        self.root = LazyNode(root[persist.SQL_Vars.id] if root else None, "")
+
+    def find_node(self, prefix):
+        """
+            Return the node spelling *prefix*, or None if no word starts with
+            it, loading the nodes on the way
+        """
+        path = [self.root]
+        node = self.root
+        for letter in prefix:
+            node = self._child(node, letter)
+            if node is None:
+                break
+            path.append(node)
+        with self._lock:
+            for path_node in reversed(path): # Move to the recent end
+                if path_node in self._expanded:
+                    del self._expanded[path_node]
+                    self._expanded[path_node] = path_node
+            self._evict()
+        return node
+
+    def _child(self, node, letter):
+        """
+            Return the child of *node* for *letter*, reading the children of
+            *node* if they aren't loaded, or if it isn't among them and they
+            were read before the last write
+        """
+        generation = self.store.result_cache.generation
+        with self._lock:
+            children = node.children
+            if children is not None and (letter in children or
+                                         node.generation == generation):
+                return children.get(letter)
+        cursor = self.store.connection().cursor()
+        node_id = node.id
+        if node is self.root: # Replaced if the tables were dropped
+            root = persist.get_root(cursor)
+            node_id = root[persist.SQL_Vars.id] if root else None
+        rows = [] if node_id is None else persist.find_children(cursor, node_id)
+        with self._lock:
+            if node.children is None or node.generation != generation:
+                node.id = node_id
+                self._load(node, rows, generation)
+            return node.children.get(letter)
+
+    def _load(self, node, rows, generation):
+        """
+            Set the children of *node* from its *rows*, keeping the children
+            already loaded that are still the same nodes
+        """
+        old_children = node.children or {}
+        node.children = {}
+        for row in rows:
+            letter = row[persist.SQL_Vars.let]
+            child = old_children.get(letter)
+            if child is None or child.id != row[persist.SQL_Vars.id]:
+                child = LazyNode(row[persist.SQL_Vars.id], letter)
+            node.children[letter] = child
+        for letter, child in old_children.iteritems():
+            if node.children.get(letter) is not child:
+                self._unload(child)
+        node.generation = generation
+        self._expanded.pop(node, None)
+        self._expanded[node] = node
+        self.loaded_nodes += len(node.children) - len(old_children)
+        self.loads += 1
+
+    def _unload(self, node):
+        """  Drop the loaded descendants of *node*  """
+        explore = [node]
+        while explore:
+            node = explore.pop()
+            if node.children is None:
+                continue
+            self._expanded.pop(node, None)
+            self.loaded_nodes -= len(node.children)
+            for child in node.children.itervalues():
+                child.top_words = None
+                explore.append(child)
+            node.children = None
+            self.evictions += 1
+
+    def _evict(self):
+        """  Drop the least recently used subtrees until under max_nodes  """
+        while self.loaded_nodes > self.max_nodes and len(self._expanded) > 1:
+            node = next(self._expanded.iterkeys())
+            if node is self.root:
+                self._expanded[node] = self._expanded.pop(node)
+                continue
+            self._unload(node)
+
+    def top_k(self, prefix, k=5):
+        """
+            Return the *k* most common (word, count) pairs starting with
+            *prefix*, from most to least common.  Up to TOPK_SIZE are kept
+            on the prefix node, larger *k* are ranked by the store
+        """
+        node = self.find_node(prefix)
+        if node is None:
+            return []
+        if k > persist.TOPK_SIZE:
+            return [tuple(pair) for pair in
+                    self.store.most_common_words(prefix, k)]
+        generation = self.store.result_cache.generation
+        with self._lock:
+            top_words = node.top_words
+            if top_words is not None and node.top_generation == generation:
+                return list(top_words[:k])
+        pairs = self.store.most_common_words(prefix, persist.TOPK_SIZE)
+        top_words = tuple(tuple(pair) for pair in pairs)
+        with self._lock:
+            node.top_words = top_words
+            node.top_generation = generation
+        return list(top_words[:k])
+
+    def iter_completions(self, prefix):
+        """
+            Yield the (word, count) pairs starting with *prefix* from most to
+            least common.  The first TOPK_SIZE come from top_k, the rest of
+            the subtree is only ranked by the database if more are asked
+            for, and streamed from a connection of its own
+        """
+        top_words = self.top_k(prefix, persist.TOPK_SIZE)
+        for pair in top_words:
+            yield pair
+        if len(top_words) < persist.TOPK_SIZE:
+            return
+        seen = set(word for word, _ in top_words)
+        conn = sqlite3.connect(self.store.path)
+        try:
+            for word, word_count in conn.execute(persist.PREFIX_WORDS_SQL,
+                    {'prefix': prefix, 'limit': -1}):
+                if word not in seen:
+                    yield (word, word_count)
+        finally:
+            conn.close()
@@ -3,30 +3,645 @@
 import sqlite3
 import string
 import autocomplete
-from nltk.corpus import brown
-from enum import Enum # Not installed on all python installations
-from collections import deque
+import ingest
+from enum import IntEnum # Not installed on all python installations
+from collections import deque, defaultdict, OrderedDict
 from operator import itemgetter
 import time
+import heapq
 import argparse
+import threading
 
 # TODO: setup schema with CONSTRAINT Node UNIQUE (p_id,char)
 
 PRINTABLE = set(string.printable)
 
-class SQL_Vars(Enum):
+DB_PATH = 'trie.db' # Database used unless set_db_path says otherwise
+STATEMENT_CACHE_SIZE = 32 # Prepared statements kept per connection
+TOPK_SIZE = 10 # Number of ranked words kept for every prefix in Prefix_Topk
+# Kept in the user_version of the database, bump when older databases need
+# upgrade_schema to do something new.  1: Prefix_Topk holds every prefix
+SCHEMA_VERSION = 1
+FETCH_CHUNK_SIZE = 10000 # Rows read at a time when scanning the whole table
+RESULT_CACHE_SIZE = 10000 # most_common_words results kept by every TrieStore
+SYNC_INTERVAL = 30 # Seconds between the writes of a TrieSyncer
+WRITE_BATCH_SIZE = 1000 # Distinct words a WriteBehindQueue commits at once
+WRITE_DELAY = 1.0 # Most seconds an update waits in a WriteBehindQueue
+
+# Walks down from the root one letter of :prefix per step to the node that
+# spells it, then collects every word in that node's subtree, ranked
+PREFIX_WORDS_SQL = """
+    WITH RECURSIVE
+        prefix_path(id, depth) AS (
+            SELECT id, 0 FROM Trie WHERE p_id IS NULL
+            UNION ALL
+            SELECT Trie.id, prefix_path.depth + 1 FROM Trie, prefix_path
+            WHERE prefix_path.depth < length(:prefix)
+              AND Trie.p_id = prefix_path.id
+              AND Trie.let = substr(:prefix, prefix_path.depth + 1, 1)),
+        subtree(id, word, count) AS (
+            SELECT Trie.id, Trie.word, Trie.count FROM Trie, prefix_path
+            WHERE prefix_path.depth = length(:prefix) AND Trie.id = prefix_path.id
+            UNION ALL
+            SELECT Trie.id, Trie.word, Trie.count FROM Trie, subtree
+            WHERE Trie.p_id = subtree.id)
+    SELECT word, count FROM subtree WHERE count > 0
+    ORDER BY count DESC LIMIT :limit"""
+
+# Connection settings for bulk loading: the load is a single transaction that
+# can simply be rerun if it fails, so durability is traded for speed
+BULK_LOAD_PRAGMAS = ("PRAGMA synchronous = OFF",
+                     "PRAGMA journal_mode = MEMORY",
+                     "PRAGMA temp_store = MEMORY",
+                     "PRAGMA cache_size = -65536")
+
+# Connection settings for a WriteBehindQueue: readers keep reading the last
+# commit while it writes, and commits are only synced to disk at checkpoints
+WRITE_BEHIND_PRAGMAS = ("PRAGMA journal_mode = WAL",
+                        "PRAGMA synchronous = NORMAL")
+
+class SQL_Vars(IntEnum): # Used to index rows, so members must be ints
     id = 0
     p_id = 1
     let = 2
     count = 3
     word = 4
 
+class ResultCache(object):
+    """
+        Bounded LRU cache of most_common_words results keyed by (prefix, k),
+        with hit and miss counts.  A change to the count of a word only
+        drops the results of its prefixes, see invalidate.
+
+        A result read from the database while a write is in progress may be
+        out of date by the time it is put back, so every put carries the
+        generation get returned and is ignored if anything was invalidated
+        since.  Writers invalidate when they change a count and again once
+        it is committed, so results read before the commit can't linger.
+    """
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict() # (prefix, k) -> words, LRU first
+        self._sizes = defaultdict(set) # prefix -> k of its cached results
+        self._generation = 0 # Bumped on every invalidation
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def generation(self):
+        """  Bumped by every invalidation, so by every write to the store  """
+        return self._generation
+
+    def get(self, prefix, k):
+        """
+            Return the cached words for (*prefix*, *k*), or None, and the
+            generation to hand to put along with the words read otherwise
+        """
+        with self._lock:
+            words = self._results.pop((prefix, k), None)
+            if words is None:
+                self.misses += 1
+            else:
+                self._results[(prefix, k)] = words # Most recently used
+                self.hits += 1
+            return words, self._generation
+
+    def put(self, prefix, k, words, generation):
+        """
+            Cache *words* for (*prefix*, *k*) unless something was invalidated
+            since *generation* was handed out by get
+        """
+        with self._lock:
+            if generation != self._generation or self.max_size <= 0:
+                return
+            self._results[(prefix, k)] = words
+            self._sizes[prefix].add(k)
+            while len(self._results) > self.max_size:
+                (old_prefix, old_k), _ = self._results.popitem(last=False)
+                sizes = self._sizes[old_prefix]
+                sizes.discard(old_k)
+                if not sizes:
+                    del self._sizes[old_prefix]
+
+    def invalidate(self, word):
+        """  Drop the results of every prefix of *word*  """
+        with self._lock:
+            self._generation += 1
+            for i in xrange(len(word)+1):
+                for k in self._sizes.pop(word[:i], ()):
+                    del self._results[(word[:i], k)]
+
+    def clear(self):
+        """  Drop every result, after writes that touch too many words  """
+        with self._lock:
+            self._generation += 1
+            self._results.clear()
+            self._sizes.clear()
+
+
 def db_connect():
     """
         Functionality used for all functions that need to connect to the database.
         Single source of truth for if database moves or changes for any reason.
     """
-    return sqlite3.connect('trie.db')
+    return sqlite3.connect(default_store().path)
+
+
+class TrieStore(object):
+    """
+        A persisted trie in the database at *path*.  Each thread that uses the
+        store gets its own long-lived connection, opened on first use, with a
+        statement cache big enough to keep every query this module issues
+        prepared.  The module level functions run against default_store().
+
+        Results of most_common_words are kept in a ResultCache of
+        *result_cache_size* entries, 0 to disable it.  It only sees writes
+        made through this store, so don't use it over a database another
+        process writes to.
+    """
+
+    def __init__(self, path=DB_PATH, cached_statements=STATEMENT_CACHE_SIZE,
+                 result_cache_size=RESULT_CACHE_SIZE):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.result_cache = ResultCache(result_cache_size)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._upgraded = False # Whether upgrade_schema has run
+
+    def connection(self):
+        """
+            Return the calling thread's connection, opening it if needed.  The
+            first connection brings the database up to date, see
+            upgrade_schema
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+                if not self._upgraded:
+                    upgrade_schema(conn)
+                    self._upgraded = True
+        return conn
+
+    def close(self):
+        """  Close the connections of every thread, they reopen on next use  """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
+
+    def add_word(self, word):
+        """
+        Adds a new word to the persistent trie and commits it
+
+        :param word: word to be added to the persisted trie
+        :returns: True if successful, False otherwise
+        """
+        conn = self.connection()
+        success = _add_word(conn.cursor(), word, cache=self.result_cache)
+        if success is False: # Don't keep a count whose top-k wasn't updated
+            conn.rollback()
+        else:
+            conn.commit()
+        self.result_cache.invalidate(sanitize(word))
+        return success
+
+    def add_words(self, words):
+        """
+        Adds multiple words to the persistent trie
+
+        :param words: an iterable strings
+        :returns: None
+        """
+        self.add_vocabulary(autocomplete.generate_vocabulary(words))
+
+    def add_vocabulary(self, vocab, shards=1):
+        """
+        Bulk load *vocab* into the persistent trie in a single transaction.
+        The new nodes are built in memory on top of the ids already in the
+        table and streamed in with executemany, and the p_id_let index is
+        rebuilt once at the end instead of being maintained on every insert.
+        Uses a connection of its own so the bulk load pragmas don't stick.
+        A database in WAL mode, see WriteBehindQueue, is left in it.
+
+        :param vocab: a dict mapping words to the number of times they were seen
+        :param shards: split *vocab* by first character with
+                       autocomplete.partition_vocabulary and load and rank
+                       one shard at a time, holding only its nodes in
+                       memory.  Each shard still scans the table once
+        :returns: None
+        :raises Exception: if things go wrong, nothing is written in that case
+        """
+        conn = sqlite3.connect(self.path)
+        conn.isolation_level = None # Transaction is managed explicitly below
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode")
+        wal = cursor.fetchone()[0] == 'wal'
+        for pragma in BULK_LOAD_PRAGMAS:
+            if wal and pragma.startswith("PRAGMA journal_mode"):
+                continue # Leaving WAL needs every other connection closed
+            cursor.execute(pragma)
+        try:
+            cursor.execute("BEGIN")
+            cursor.execute("PRAGMA user_version")
+            complete = cursor.fetchone()[0] >= SCHEMA_VERSION
+            create_table(cursor, with_index=False)
+            if not complete: # Nothing to rank in an empty table either
+                cursor.execute("""SELECT 1 FROM Trie LIMIT 1""")
+                complete = cursor.fetchone() is None
+            # Shards can only be ranked on their own on top of complete lists
+            sharded = shards > 1 and complete
+            cursor.execute("DROP INDEX IF EXISTS p_id_let_ind")
+            if shards > 1:
+                vocab_shards = autocomplete.partition_vocabulary(vocab, shards)
+            else:
+                vocab_shards = [vocab]
+            for vocab_shard in vocab_shards:
+                new_rows, count_updates = _bulk_rows(cursor, vocab_shard, 
+                                                     shards > 1)
+                cursor.executemany("""INSERT INTO Trie (id, p_id, let, count, word)
+                    VALUES (?, ?, ?, ?, ?)""", new_rows)
+                cursor.executemany("""UPDATE Trie SET count = count + ? WHERE id = ?""",
+                                   count_updates)
+                if sharded:
+                    rebuild_prefix_topk(cursor, set(
+                        sanitize(word)[:1] for word in vocab_shard) - set(['']))
+            create_index(cursor)
+            root = get_root(cursor)
+            if not sharded:
+                rebuild_prefix_topk(cursor)
+            elif root:
+                _rank_prefix(cursor, root) # Merge the shards
+            cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+            self.result_cache.clear()
+
+    def write_trie(self, trie):
+        """
+        Persist a trie structure to the db.  Every word in the trie is stored
+        with its count in the trie, so writing the same trie again changes
+        nothing and sync_trie can carry on from any write.  Words are keyed
+        by sanitize, as sync_trie and add_word do, and words only in the db
+        are left as they are.  Nothing is written if it fails, and the
+        changes taken from the trie are handed back
+
+        :param trie: A Trie object
+        :returns: True if successful, False if found error
+        :raises Exception: if things go wrong
+        """
+        conn = self.connection()
+        cursor = conn.cursor()
+        changes = trie.take_changes() # Written along with everything else
+        try:
+            create_table(cursor)
+            counts = defaultdict(int) # sanitized word -> count in the trie
+            for word, word_count in trie.words_from_node(trie.root):
+                counts[sanitize(word)] += word_count
+            for word in changes: # Words whose count went down to 0
+                counts[sanitize(word)] += 0
+            for word, word_count in sorted(counts.iteritems()): # Shared prefixes
+                if word and not _set_word_count(cursor, word, word_count):
+                    conn.rollback()
+                    trie.restore_changes(changes)
+                    return False
+            conn.commit()
+        except:
+            conn.rollback()
+            trie.restore_changes(changes)
+            raise
+        self.result_cache.clear()
+        return True
+
+    def sync_trie(self, trie):
+        """
+        Write the count changes made to *trie* since it was last written or
+        synced (see autocomplete.Trie.take_changes) in one transaction.  Only
+        the changed words are touched, so a sync costs as much as the changes
+        rather than the whole trie.  If it fails nothing is written and the
+        changes are handed back to the trie for the next sync.
+
+        :param trie: A Trie object
+        :returns: the number of words written
+        :raises Exception: if things go wrong
+        """
+        changes = trie.take_changes()
+        if not changes:
+            return 0
+        conn = self.connection()
+        cursor = conn.cursor()
+        try:
+            create_table(cursor)
+            for word, delta in sorted(changes.iteritems()): # Shared prefixes
+                if _add_word(cursor, word, delta, self.result_cache) is False:
+                    raise sqlite3.DatabaseError("Could not update " + word)
+            conn.commit()
+        except:
+            conn.rollback()
+            trie.restore_changes(changes)
+            raise
+        for word in changes:
+            self.result_cache.invalidate(sanitize(word))
+        return len(changes)
+
+    def search_pref_db(self, prefix):
+        """
+            Find and return a list of the words that begin with *prefix* 
+            sorted from most to least common
+        """
+        return top_words_db(self.connection().cursor(), prefix)
+
+    def most_common_words(self, prefix, count=5):
+        """
+            Return the most common *count* words associated with a particular 
+            prefix.  Up to TOPK_SIZE words are read straight from the 
+            Prefix_Topk table, the subtree is only ranked for larger counts.
+            Results are cached, see ResultCache
+        """
+        cached, generation = self.result_cache.get(prefix, count)
+        if cached is not None:
+            return [list(pair) for pair in cached]
+        cursor = self.connection().cursor()
+        if count <= TOPK_SIZE:
+            cursor.execute("""SELECT word, count FROM Prefix_Topk WHERE prefix = ?
+                ORDER BY count DESC, word LIMIT ?""", (prefix, count))
+            prefixed_words = [list(row) for row in cursor.fetchall()]
+        else:
+            prefixed_words = top_words_db(cursor, prefix, count)
+        self.result_cache.put(prefix, count,
+                              tuple(tuple(pair) for pair in prefixed_words),
+                              generation)
+        return prefixed_words
+
+    def drop_table(self):
+        """  Drop the Trie tables, leaving empty ones in their place  """
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute("""DROP TABLE IF EXISTS Trie""")
+        cursor.execute("""DROP TABLE IF EXISTS Prefix_Topk""")
+        create_table(cursor) # leave base table instantiation
+        conn.commit()
+        self.result_cache.clear()
+
+    def rebuild_prefix_topk(self):
+        """  Rank every prefix in the Prefix_Topk table again  """
+        conn = self.connection()
+        cursor = conn.cursor()
+        create_table(cursor)
+        rebuild_prefix_topk(cursor)
+        conn.commit()
+        self.result_cache.clear()
+
+
+class TrieSyncer(threading.Thread):
+    """
+        Background thread syncing the changes made to a live *trie* to
+        *store* every *interval* seconds, see TrieStore.sync_trie.  A failed
+        sync is counted and its changes left for the next one, and stop
+        syncs whatever changed since the last one before returning.
+    """
+
+    def __init__(self, store, trie, interval=SYNC_INTERVAL):
+        threading.Thread.__init__(self, name="TrieSyncer")
+        self.daemon = True
+        self.store = store
+        self.trie = trie
+        self.interval = interval
+        self.syncs = 0
+        self.words_synced = 0
+        self.failures = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sync()
+
+    def sync(self):
+        """  Sync now, returning False if the write failed  """
+        try:
+            self.words_synced += self.store.sync_trie(self.trie)
+        except sqlite3.Error:
+            self.failures += 1
+            return False
+        self.syncs += 1
+        return True
+
+    def stop(self):
+        """  Stop the thread and sync one last time  """
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        return self.sync()
+
+
+class WriteBehindQueue(object):
+    """
+        Queue of word count updates written to *store* by a background
+        thread.  add_word returns at once, repeated words are merged into
+        one update, and the writer commits them together once *batch_size*
+        distinct words are waiting or the oldest has waited *max_delay*
+        seconds, so a burst of updates costs one commit instead of one
+        each.  The database is switched to WAL mode so readers aren't
+        blocked while it writes.
+
+        Updates are only durable once written: call flush to wait for
+        them, and close before exiting.  A failed commit is counted and
+        its updates kept for the next one.
+    """
+
+    def __init__(self, store=None, batch_size=WRITE_BATCH_SIZE,
+                 max_delay=WRITE_DELAY):
+        self.store = store or default_store()
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.updates = 0 # add_word calls
+        self.words_written = 0 # Distinct words committed
+        self.commits = 0
+        self.failures = 0
+        self.last_commit_latency = 0.0 # Seconds the last commit took
+        self.max_commit_latency = 0.0
+        self.total_commit_latency = 0.0
+        self._pending = defaultdict(int) # word -> count waiting to be written
+        self._oldest = None # When the oldest pending update arrived
+        self._writing = 0 # Words being written right now
+        self._flushes = 0 # Threads waiting in flush
+        self._closed = False
+        self._stopped = False # Set once the writer thread is done
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, 
+                                        name="WriteBehindQueue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """  Distinct words waiting to be written or being written  """
+        with self._cond:
+            return len(self._pending) + self._writing
+
+    @property
+    def mean_commit_latency(self):
+        return self.total_commit_latency / max(1, self.commits)
+
+    def add_word(self, word, count=1):
+        """
+        Queue *count* more sightings of *word*
+
+        :param word: word to be added to the persisted trie
+        :param count: Count of times word has been seen that should be added
+        :returns: nothing
+        :raises ValueError: if the queue is closed
+        """
+        if not word:
+            return
+        with self._cond:
+            if self._closed:
+                raise ValueError("add_word on a closed WriteBehindQueue")
+            self._pending[word] += count
+            self.updates += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._cond.notify_all() # Start timing the batch
+            elif len(self._pending) == self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        Wait until every update queued so far is committed
+
+        :returns: True if successful, False if a commit failed, in which case
+                  the updates stay queued
+        """
+        with self._cond:
+            failures = self.failures
+            self._flushes += 1
+            self._cond.notify_all()
+            try:
+                while (self._pending or self._writing) and \
+                        self.failures == failures and not self._stopped:
+                    self._cond.wait()
+            finally:
+                self._flushes -= 1
+            return not self._pending and not self._writing
+
+    def close(self):
+        """
+        Write everything queued and stop the writer.  Later add_word calls
+        raise ValueError
+
+        :returns: True if successful, False if updates were left unwritten
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        return not self._pending
+
+    def _run(self):
+        """  Writer thread, see _write_batches  """
+        try:
+            self._write_batches()
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    def _write_batches(self):
+        """  Wait for a batch to be due and commit it until closed  """
+        cursor = self.store.connection().cursor()
+        for pragma in WRITE_BEHIND_PRAGMAS:
+            cursor.execute(pragma)
+        create_table(cursor)
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed and not self._pending:
+                        return
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(0, self._oldest + self.max_delay - 
+                                      time.time())
+                    self._cond.wait(timeout)
+                batch, self._pending = self._pending, defaultdict(int)
+                self._oldest = None
+                self._writing = len(batch)
+            written = self._write(batch)
+            with self._cond:
+                self._writing = 0
+                if not written:
+                    for word, count in batch.iteritems():
+                        self._pending[word] += count
+                    self._oldest = time.time() # Retry after max_delay
+                self._cond.notify_all()
+                if not written and self._closed:
+                    return # Don't retry forever on the way out
+
+    def _due(self):
+        """  Whether the pending updates should be written now  """
+        return bool(self._pending) and (
+            self._closed or self._flushes or
+            len(self._pending) >= self.batch_size or
+            time.time() >= self._oldest + self.max_delay)
+
+    def _write(self, batch):
+        """  Commit *batch* in one transaction, returning False if it failed  """
+        conn = self.store.connection()
+        cursor = conn.cursor()
+        start = time.time()
+        try:
+            for word, count in sorted(batch.iteritems()): # Shared prefixes
+                if _add_word(cursor, word, count, 
+                             self.store.result_cache) is False:
+                    raise sqlite3.DatabaseError("Could not update " + word)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            self.failures += 1
+            return False
+        latency = time.time() - start
+        for word in batch:
+            self.store.result_cache.invalidate(sanitize(word))
+        self.commits += 1
+        self.words_written += len(batch)
+        self.last_commit_latency = latency
+        self.max_commit_latency = max(self.max_commit_latency, latency)
+        self.total_commit_latency += latency
+        return True
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def default_store():
+    """  The TrieStore used by the module level functions  """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = TrieStore(DB_PATH)
+        return _default_store
+
+def set_db_path(path):
+    """  Point the module level functions at the database in *path*  """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is not None:
+            _default_store.close()
+        _default_store = TrieStore(path)
 
 def get_root(cursor):
     """
@@ -42,27 +657,23 @@ def get_root(cursor):
 def add_word(word):
     """
     Adds a new word to the persistent trie, used for calling from
-    another module.  Opens connection to database
+    another module.  Uses the default store's connection
 
     :param word: word to be added to the persisted trie
     :returns: True if successful, False otherwise
     :raises Exception: if things go wrong
     """
 
-    conn = db_connect()
-    cursor = conn.cursor()
-    success = _add_word(cursor, word)
-    conn.commit()
-    conn.close()
-    return success
+    return default_store().add_word(word)
 
-def _add_word(cursor, word, count=1):
+def _add_word(cursor, word, count=1, cache=None):
     """
     Adds a new word to the persistent trie, used internally with
     add_words.  Assumes cursor to db can be passed in 
     :param cursor: the sqlite db cursor
     :param word: word to be added to the persisted trie
     :param count: Count of times word has been seen that should be added
+    :param cache: ResultCache to drop the results of the word's prefixes from
     :returns: nothing
     :raises Exception: if things go wrong
     """
@@ -92,11 +703,26 @@ def _add_word(cursor, word, count=1):
                 (p_id, l))
             p_id = cursor.fetchone()[0]
 
-    if update_node(cursor, p_id, count) == -1:
+    if update_node(cursor, p_id, count, cache) == -1:
         return False
     return True
 
-def insert_node(cursor, p_id, char, count, word):
+def _set_word_count(cursor, word, count):
+    """
+    Store *count* as the count of *word*, adding the word if it is new
+
+    :param cursor: the sqlite db cursor
+    :param word: sanitized word to be stored
+    :param count: the count it should have
+    :returns: True if successful, False otherwise
+    """
+    node = _find_node_db(cursor, word)
+    if node is None:
+        return not count or _add_word(cursor, word, count) is not False
+    delta = count - node[SQL_Vars.count]
+    return not delta or update_node(cursor, node[SQL_Vars.id], delta) != -1
+
+def insert_node(cursor, p_id, char, count, word, cache=None):
     """
     Helper function to insert individual characters. Returns the resulting id
     if successful or None if unsuccessful
@@ -105,6 +731,7 @@ def insert_node(cursor, p_id, char, count, word):
     :param p_id: the id of the node's p_id
     :param char: the character node to be inserted
     :param count: number of times the character appears
+    :param cache: ResultCache to drop the results of the word's prefixes from
     :returns: the id of the row in the db
     """
 
@@ -113,23 +740,146 @@ def insert_node(cursor, p_id, char, count, word):
             VALUES (?, ?, ?, ?)""", (p_id, char, count, word))
         cursor.execute("""SELECT * FROM Trie WHERE p_id IS ? AND let IS ?""",
                             (p_id, char))
-        return cursor.fetchone()[0]
+        node_id = cursor.fetchone()[0]
+        if count:
+            _update_topk(cursor, word, count, count < 0)
+            if cache is not None:
+                cache.invalidate(word)
+        return node_id
     except:
         return -1
 
-def update_node(cursor, id, count):
+def update_node(cursor, id, count, cache=None):
     """
         Use *cursor* to update the count of entries at *id* in db table by *count*
+        and drop the results of the prefixes of its word from *cache*.
         Returns 0 on success, -1 on failure
     """
 
     try:
         cursor.execute("""UPDATE Trie SET Count = Count + ? WHERE id = ?""", 
                       (count, id))
+        if count:
+            cursor.execute("""SELECT word, count FROM Trie WHERE id = ?""", 
+                           (id,))
+            word, word_count = cursor.fetchone()
+            _update_topk(cursor, word, word_count, count < 0)
+            if cache is not None:
+                cache.invalidate(word)
         return 0
     except:
         return -1
 
+def _update_topk(cursor, word, count, decreased=False):
+    """
+    Bring the Prefix_Topk rows of every prefix of *word* up to date after its
+    count changed to *count*.  Only the ancestors of the word are touched: it
+    is inserted into each of their lists, which are then trimmed back to
+    TOPK_SIZE.  When a count goes down another word may now belong in a list
+    it wasn't in, so those lists are ranked again, see _rerank_topk.
+
+    :param cursor: the sqlite db cursor
+    :param word: word whose count changed
+    :param count: the new count of *word*
+    :param decreased: True if the count went down
+    :returns: nothing
+    """
+    if decreased:
+        _rerank_topk(cursor, word)
+        return
+    prefixes = [word[:i] for i in xrange(len(word)+1)]
+    cursor.executemany("""INSERT OR REPLACE INTO Prefix_Topk (prefix, word, count)
+        VALUES (?, ?, ?)""", [(prefix, word, count) for prefix in prefixes])
+    cursor.executemany("""DELETE FROM Prefix_Topk WHERE prefix = ? AND word NOT IN
+        (SELECT word FROM Prefix_Topk WHERE prefix = ? 
+         ORDER BY count DESC, word LIMIT ?)""",
+        [(prefix, prefix, TOPK_SIZE) for prefix in prefixes])
+
+def _rerank_topk(cursor, word):
+    """
+    Rank the Prefix_Topk lists of every prefix of *word* again, deepest
+    first, each from the count of its own node and the lists of its
+    children.  Lists off the path are left alone, so the cost depends on
+    the length of the word and not the size of the subtrees.
+
+    :param cursor: the sqlite db cursor
+    :param word: word whose count went down
+    :returns: nothing
+    """
+    path = [get_root(cursor)]
+    for l in word:
+        cursor.execute("""SELECT * FROM Trie WHERE p_id = ? AND let = ?""",
+                       (path[-1][SQL_Vars.id], l))
+        path.append(cursor.fetchone())
+    for node in reversed(path):
+        _rank_prefix(cursor, node)
+
+def _rank_prefix(cursor, node):
+    """
+    Rewrite the Prefix_Topk list of *node*, a row of the Trie table, from
+    its own count and the lists of its children
+
+    :param cursor: the sqlite db cursor
+    :param node: the row of the node spelling the prefix
+    :returns: nothing
+    """
+    cursor.execute("""SELECT Prefix_Topk.word, Prefix_Topk.count
+        FROM Trie, Prefix_Topk 
+        WHERE Trie.p_id = ? AND Prefix_Topk.prefix = Trie.word""",
+        (node[SQL_Vars.id],))
+    candidates = cursor.fetchall()
+    if node[SQL_Vars.count] > 0:
+        candidates.append((node[SQL_Vars.word], node[SQL_Vars.count]))
+    prefix = node[SQL_Vars.word]
+    cursor.execute("""DELETE FROM Prefix_Topk WHERE prefix = ?""", (prefix,))
+    cursor.executemany("""INSERT INTO Prefix_Topk (prefix, word, count)
+        VALUES (?, ?, ?)""", [(prefix, top_word, top_count) 
+        for top_word, top_count in heapq.nsmallest(
+            TOPK_SIZE, candidates, key=lambda x: (-x[1], x[0]))])
+
+def rebuild_prefix_topk(cursor, first_letters=None):
+    """
+    Rank the words under every node and rewrite the whole Prefix_Topk table
+    from a single scan of the nodes.  Used after bulk loads and to fill the
+    table for databases written before it existed.
+
+    :param cursor: the sqlite db cursor
+    :param first_letters: only rank the prefixes starting with one of these
+                          letters, reading only their nodes.  The root is
+                          left for _rank_prefix
+    :returns: nothing
+    """
+    children = defaultdict(list)
+    nodes = []
+    if first_letters is None:
+        cursor.execute("""SELECT id, p_id, count, word FROM Trie ORDER BY id""")
+    else:
+        first_letters = sorted(first_letters)
+        cursor.execute("""SELECT id, p_id, count, word FROM Trie
+            WHERE substr(word, 1, 1) IN (%s) ORDER BY id""" % 
+            ','.join('?' * len(first_letters)), first_letters)
+    for node_id, p_id, word_count, word in cursor.fetchall():
+        children[p_id].append(node_id)
+        nodes.append((node_id, word_count, word))
+    ranked = {} # id -> most common (count, word) pairs under the node
+    rows = []
+    for node_id, word_count, word in reversed(nodes): # Children first
+        candidates = [(word_count, word)] if word_count else []
+        for child_id in children.pop(node_id, ()):
+            candidates.extend(ranked.pop(child_id))
+        ranked[node_id] = heapq.nsmallest(TOPK_SIZE, candidates, 
+                                          key=lambda x: (-x[0], x[1]))
+        rows.extend((word, top_word, top_count) 
+                    for top_count, top_word in ranked[node_id])
+    if first_letters is None:
+        cursor.execute("""DELETE FROM Prefix_Topk""")
+    else: # Words are printable ascii, see sanitize
+        cursor.executemany("""DELETE FROM Prefix_Topk 
+            WHERE prefix >= ? AND prefix < ?""",
+            [(l, chr(ord(l) + 1)) for l in first_letters])
+    cursor.executemany("""INSERT INTO Prefix_Topk (prefix, word, count)
+        VALUES (?, ?, ?)""", rows)
+
 
 def find_children(cursor, p_id):
     """Return all child nodes of parent indicated by *p_id*"""
@@ -137,6 +887,22 @@ def find_children(cursor, p_id):
     cursor.execute("""SELECT * FROM Trie WHERE p_id = ?""", [p_id])
     return cursor.fetchall()
 
+def iter_node_chunks(cursor, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Scan every node in the table in id order, so parents come before their
+    children, without loading the whole table at once
+
+    :param cursor: the sqlite db cursor
+    :param chunk_size: number of rows fetched per round trip
+    :returns: a generator of lists of (id, p_id, let, count) tuples
+    """
+    cursor.execute("""SELECT id, p_id, let, count FROM Trie ORDER BY id""")
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
 def add_words(words):
     """
     Adds multiple words to the persisten trie
@@ -144,22 +910,72 @@ def add_words(words):
     :param words: an iterable strings
     :returns: None
     """
-    print "---------\n\n\n"
-    vocab = autocomplete.generate_vocabulary(words)
-    conn = db_connect()
-    cursor = conn.cursor()
-    create_table(cursor)
-    num_words = len(vocab)
-    i = 0
-    for word in vocab:
-        _add_word(cursor, word, vocab[word])
-        i += 1
-        if i%50 == 0:
-            print str(i) + '/' + str(num_words)
-    conn.commit()
-    conn.close()
+    default_store().add_words(words)
+
+def add_vocabulary(vocab, shards=1):
+    """
+    Bulk load *vocab* into the persistent trie in a single transaction
+
+    :param vocab: a dict mapping words to the number of times they were seen
+    :param shards: number of shards to load it in, see TrieStore.add_vocabulary
+    :returns: None
+    :raises Exception: if things go wrong, nothing is written in that case
+    """
+    default_store().add_vocabulary(vocab, shards)
+
+def _bulk_rows(cursor, vocab, shard_only=False):
+    """
+    Work out the rows a bulk load of *vocab* has to write, reading the nodes
+    already in the table with a single scan
+
+    :param cursor: the sqlite db cursor
+    :param vocab: a dict mapping words to counts
+    :param shard_only: only keep the existing nodes of words starting with
+                       the same characters as the words in *vocab*
+    :returns: a list of (id, p_id, let, count, word) rows to insert and a list
+              of (count, id) pairs to add to existing nodes
+    """
+    words = [(sanitize(word), word_count) 
+             for word, word_count in vocab.iteritems()]
+    first_letters = set(word[:1] for word, _ in words)
+    node_ids = {} # (p_id, let) -> id of every node, existing or new
+    root_id = None
+    next_id = 1
+    cursor.execute("""SELECT id, p_id, let, substr(word, 1, 1) FROM Trie""")
+    for node_id, p_id, let, first_letter in cursor:
+        if p_id is None:
+            root_id = node_id
+        elif not shard_only or first_letter in first_letters:
+            node_ids[(p_id, let)] = node_id
+        next_id = max(next_id, node_id + 1)
+
+    new_rows = {} # id -> row of nodes that aren't in the table yet
+    if root_id is None:
+        root_id = next_id
+        next_id += 1
+        new_rows[root_id] = [root_id, None, '', 0, '']
+    count_updates = {}
+    for word, word_count in words:
+        if not word:
+            continue
+        p_id = root_id
+        for i, l in enumerate(word):
+            node_id = node_ids.get((p_id, l))
+            if node_id is None:
+                node_id = next_id
+                next_id += 1
+                node_ids[(p_id, l)] = node_id
+                new_rows[node_id] = [node_id, p_id, l, 0, word[:i+1]]
+            p_id = node_id
+        if p_id in new_rows:
+            new_rows[p_id][SQL_Vars.count] += word_count
+        else:
+            count_updates[p_id] = count_updates.get(p_id, 0) + word_count
+    return ([new_rows[node_id] for node_id in sorted(new_rows)],
+            [(word_count, node_id) 
+             for node_id, word_count in count_updates.iteritems()])
 
-def create_table(cursor):
+def create_table(cursor, with_index=True):
     """
         SQL functionality to create a table specified by *table_name* if it 
         doesn't exist and add the p_id_let index to speed up searching
@@ -172,6 +988,39 @@ def create_table(cursor):
                         count INT,
                         word TEXT);
             """)
+    if with_index:
+        create_index(cursor)
+    cursor.execute("""CREATE TABLE IF NOT EXISTS Prefix_Topk (
+                        prefix TEXT,
+                        word TEXT,
+                        count INT,
+                        PRIMARY KEY (prefix, word));
+            """)
+    cursor.execute("""CREATE INDEX IF NOT EXISTS prefix_count_ind 
+                      ON Prefix_Topk (prefix, count);""")
+
+def upgrade_schema(conn):
+    """
+    Create the tables if they're missing and bring a database written by an
+    older version up to SCHEMA_VERSION, ranking every prefix into Prefix_Topk
+    if it was created before the table existed.  Prefix_Topk is only kept
+    up to date incrementally, so it has to be complete before any write
+
+    :param conn: a connection to the database
+    :returns: nothing
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA user_version")
+    if cursor.fetchone()[0] >= SCHEMA_VERSION:
+        return
+    create_table(cursor)
+    rebuild_prefix_topk(cursor)
+    conn.commit()
+    cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+    conn.commit()
+
+def create_index(cursor):
+    """  Add the p_id_let index used to find the children of a node  """
     cursor.execute("CREATE INDEX IF NOT EXISTS p_id_let_ind ON Trie (p_id, let);")
 
 def write_trie(Trie):
@@ -181,36 +1030,17 @@ def write_trie(Trie):
     :param Trie: A Trie object
     :returns: True if successful, False if found error
     """
+    return default_store().write_trie(Trie)
 
-    conn = db_connect()
-    cursor = conn.cursor()
-
-    create_table(cursor)
-    explore = deque()
-    explore.append((Trie.root,None))
-
-    while explore:
-        curr_node, p_id = explore.pop()
-        if p_id and p_id % 50 == 0:
-            print p_id
-        cursor.execute("""SELECT id FROM Trie WHERE p_id=? AND let=?""", 
-                      (p_id, curr_node.letter))
-        next_p_id = cursor.fetchone()
-        if next_p_id: # If the Trie node already exists in the table
-            next_p_id = next_p_id[0]
-            if update_node(cursor, next_p_id, curr_node.word_counts) == -1:
-                return False
-        else: # Need to make new entry in table for Trie
-            next_p_id = insert_node(cursor, p_id, curr_node.letter, curr_node.word_counts, curr_node.word)
-            print next_p_id
-            if next_p_id == -1:
-                return False
-        for child in curr_node.children:
-            explore.appendleft((child, next_p_id))
+def sync_trie(trie):
+    """
+    Write the count changes made to *trie* since it was last written or
+    synced, see TrieStore.sync_trie
 
-    conn.commit()
-    conn.close()
-    return True
+    :param trie: A Trie object
+    :returns: the number of words written
+    """
+    return default_store().sync_trie(trie)
 
 def sanitize(word):
     """
@@ -267,46 +1097,43 @@ def words_from_node_db(cursor, node):
             explore.appendleft(child)
     return all_prefixed_words
 
+def top_words_db(cursor, prefix, count=-1):
+    """
+    Find the words that begin with *prefix* in a single statement: the prefix
+    is resolved and its subtree ranked inside SQLite
+
+    :param cursor: the sqlite db cursor
+    :param prefix: string the words start with
+    :param count: number of words to return, -1 for all of them
+    :returns: a list of [word, count] pairs from most to least common
+    """
+    cursor.execute(PREFIX_WORDS_SQL, {'prefix': prefix, 'limit': count})
+    return [list(row) for row in cursor.fetchall()]
+
 def search_pref_db(prefix): # finding all words necessary for future functionality
     """
         Find and return a list of the words that begin with *prefix* found in
         the database speficied by *db_cursor* sorted from most to least common
     """
-
-    conn = db_connect()
-    cursor = conn.cursor()
-
-    curr_node = _find_node_db(cursor, prefix)
-    prefixed_words = words_from_node_db(cursor, curr_node)
-
-    conn.close()
-    return prefixed_words
+    return default_store().search_pref_db(prefix)
 
 def drop_table():
     """
         Outer functionality to drop the Trie table if needed
     """
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute("""DROP TABLE IF EXISTS Trie""")
-    create_table(cursor) # leave base table instantiation
-    conn.close()
+    default_store().drop_table()
 
 def add_brown_to_db(num_sentences=50000):
     """
         Add the first *num_sentences* sentences from the Brown corpus to the db
     """
-    sentences = brown.sents()[:num_sentences]
-    words = [word for sentence in sentences for word in sentence]
-    add_words(words)
+    add_words(ingest.brown_words(num_sentences))
 
 def most_common_words(prefix, count=5):
     """
         Return the most common *count* words associated with a particular prefix
     """
-    prefixed_words = search_pref_db(prefix)
-    prefixed_words.sort(key=lambda x: -x[1])
-    return prefixed_words[:count]
+    return default_store().most_common_words(prefix, count)
 
 def run_interpreter_db(top_words=5):
     """
@@ -334,9 +1161,14 @@ def main():
     parser.add_argument("-add_words", action="store_true") # TODO: let person indicate how many to add
     parser.add_argument("-no_Int", action="store_true") # don't want to run interpreter
     parser.add_argument("-clear_db", action="store_true")
+    parser.add_argument("-rebuild_topk", action="store_true") # rank every prefix again
+    parser.add_argument("-db_path", default=DB_PATH)
     args = parser.parse_args()
+    set_db_path(args.db_path)
     if args.clear_db:
         drop_table()
+    if args.rebuild_topk:
+        default_store().rebuild_prefix_topk()
     if args.add_words:
         add_brown_to_db()
     if not args.no_Int:
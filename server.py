@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+import argparse
+import asynchat
+import asyncore
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+import autocomplete
+import frozentrie
+import lazytrie
+import persist
+
+DEFAULT_PORT = 7777
+DB_WORKERS = 4 # Threads running database queries
+MAX_PENDING_QUERIES = 256 # Distinct database queries queued or running at once
+MAX_LINE = 4096 # Longest request line accepted, in bytes
+MAX_K = 100 # Most completions a request may ask for
+
+
+class TrieBackend(object):
+    """
+        Completions from a Trie or FrozenTrie in memory.  A cached top_k is
+        quick enough to answer straight from the event loop.
+    """
+
+    blocking = False
+
+    def __init__(self, trie):
+        self.trie = trie
+
+    def complete(self, prefix, k):
+        return self.trie.top_k(prefix, k)
+
+
+class StoreBackend(object):
+    """
+        Completions from a persist.TrieStore.  Queries block on sqlite, so the
+        server runs them on its executor.
+    """
+
+    blocking = True
+
+    def __init__(self, store):
+        self.store = store
+
+    def complete(self, prefix, k):
+        return self.store.most_common_words(prefix, k)
+
+
+class LazyTrieBackend(TrieBackend):
+    """
+        Completions from a lazytrie.LazyTrie, which may have to read nodes
+        from the database, so queries run on the executor
+    """
+
+    blocking = True
+
+
+class _Request(object):
+    """  A request waiting on a query run by the executor  """
+
+    __slots__ = ('channel', 'id', 'session', 'cancelled')
+
+    def __init__(self, channel, request_id, session):
+        self.channel = channel
+        self.id = request_id
+        self.session = session
+        self.cancelled = False
+
+
+class CompletionChannel(asynchat.async_chat):
+    """
+        One client connection.  Requests and responses are JSON objects, one
+        per line.  A line longer than MAX_LINE is answered with an error and
+        the rest of it is ignored, requests resume on the next line.
+    """
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, server.socket_map)
+        self.server = server
+        self._incoming = []
+        self._incoming_len = 0
+        self._discarding = False # Set while the rest of a long line is skipped
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        if self._discarding:
+            return
+        self._incoming.append(data)
+        self._incoming_len += len(data)
+        if self._incoming_len > MAX_LINE:
+            self.send_message({'error': "request too long"})
+            self._discarding = True
+            self._incoming = []
+            self._incoming_len = 0
+
+    def found_terminator(self):
+        if self._discarding:
+            self._discarding = False
+            return
+        line = ''.join(self._incoming).strip()
+        self._incoming = []
+        self._incoming_len = 0
+        if line:
+            self.server.handle_line(self, line)
+
+    def send_message(self, message):
+        if self.connected:
+            self.push(json.dumps(message) + '\n')
+
+    def handle_close(self):
+        self.server.channel_closed(self)
+        self.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """
+        Read end of a pipe the executor threads write to once a result is
+        ready, waking the event loop to deliver it
+    """
+
+    def __init__(self, server):
+        self._read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read_fd,
+                                          server.socket_map)
+        os.close(self._read_fd) # file_dispatcher keeps its own duplicate
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.deliver_results()
+
+    def wake(self):
+        os.write(self.write_fd, 'x')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class CompletionServer(asyncore.dispatcher):
+    """
+        Line delimited JSON completion service.  A request looks like
+
+            {"id": 1, "prefix": "th", "k": 5, "session": "tab-1"}
+
+        and is answered with {"id": 1, "completions": [[word, count], ...]},
+        or {"id": 1, "error": message}.  Only "prefix" is required.  Requests
+        belong to their connection's session unless they name another, and a
+        new request cancels the session's unanswered one, which is answered
+        with {"id": ..., "cancelled": true} rather than its completions.
+
+        Backends that block, see StoreBackend, are queried on a bounded pool
+        of threads so the event loop never waits on them.  Identical queries
+        in flight at the same time are run once and the result shared, and
+        queries whose requests have all been cancelled are skipped.
+
+        *listener* is an already listening socket to accept from, shared by
+        the processes started by fork_workers; *host* and *port* are only
+        used without one.
+    """
+
+    def __init__(self, backend, host='127.0.0.1', port=DEFAULT_PORT,
+                 workers=DB_WORKERS, max_pending=MAX_PENDING_QUERIES,
+                 listener=None):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.backend = backend
+        self.max_pending = max_pending
+        self._sessions = {} # (channel, session) -> its unanswered _Request
+        self._in_flight = {} # (prefix, k) -> _Requests waiting on the query
+        self._lock = threading.Lock() # Guards _in_flight
+        self._results = Queue()
+        self._executor = None
+        self._waker = None
+        if backend.blocking:
+            self._executor = ThreadPool(workers)
+            self._waker = _Waker(self)
+        if listener is not None:
+            listener.setblocking(0)
+            self.set_socket(listener)
+            self.accepting = True
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind((host, port))
+            self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            CompletionChannel(pair[0], self)
+
+    def serve_forever(self, timeout=30.0):
+        asyncore.loop(timeout, map=self.socket_map)
+
+    def shutdown(self):
+        """  Close every connection and stop the executor  """
+        asyncore.close_all(self.socket_map)
+        if self._executor:
+            self._executor.terminate()
+
+    def handle_line(self, channel, line):
+        """  Parse a request from *channel* and answer or queue it  """
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("request must be an object")
+        except ValueError as e:
+            channel.send_message({'error': "bad request: %s" % e})
+            return
+        request_id = message.get('id')
+        prefix = message.get('prefix')
+        k = message.get('k', 5)
+        if not isinstance(prefix, basestring):
+            channel.send_message({'id': request_id,
+                                  'error': "prefix must be a string"})
+            return
+        if not isinstance(k, int) or not 0 < k <= MAX_K:
+            channel.send_message({'id': request_id,
+                                  'error': "k must be between 1 and %d" % MAX_K})
+            return
+        prefix = prefix.lower()
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+
+        session = (channel, message.get('session'))
+        stale = self._sessions.pop(session, None)
+        if stale is not None:
+            stale.cancelled = True
+            channel.send_message({'id': stale.id, 'cancelled': True})
+        if not self.backend.blocking:
+            channel.send_message({'id': request_id,
+                                  'completions': self.backend.complete(prefix, k)})
+            return
+
+        request = _Request(channel, request_id, session)
+        query = (prefix, k)
+        with self._lock:
+            waiting = self._in_flight.get(query)
+            if waiting is None and len(self._in_flight) >= self.max_pending:
+                channel.send_message({'id': request_id, 'error': "server busy"})
+                return
+            self._sessions[session] = request
+            if waiting is not None: # Coalesce with the query already queued
+                waiting.append(request)
+                return
+            self._in_flight[query] = [request]
+        self._executor.apply_async(self._run_query, (query,))
+
+    def _run_query(self, query):
+        """  Executor half of a query: run it unless nobody wants it now  """
+        with self._lock:
+            if not any(not request.cancelled
+                       for request in self._in_flight[query]):
+                del self._in_flight[query]
+                return
+        try:
+            self._results.put((query, self.backend.complete(*query), None))
+        except Exception as e:
+            self._results.put((query, None, str(e)))
+        self._waker.wake()
+
+    def deliver_results(self):
+        """  Answer the requests waiting on every query that has finished  """
+        while True:
+            try:
+                query, completions, error = self._results.get_nowait()
+            except Empty:
+                return
+            with self._lock:
+                waiting = self._in_flight.pop(query)
+            for request in waiting:
+                if request.cancelled:
+                    continue
+                if self._sessions.get(request.session) is request:
+                    del self._sessions[request.session]
+                if error is None:
+                    request.channel.send_message({'id': request.id,
+                                                  'completions': completions})
+                else:
+                    request.channel.send_message({'id': request.id,
+                                                  'error': error})
+
+    def channel_closed(self, channel):
+        """  Cancel the unanswered requests of a closed connection  """
+        for session in [session for session in self._sessions
+                        if session[0] is channel]:
+            self._sessions.pop(session).cancelled = True
+
+
+def listen(host='127.0.0.1', port=DEFAULT_PORT):
+    """  Return a socket listening on *host*:*port*, for fork_workers  """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    return listener
+
+def fork_workers(backend, listener, processes, workers=DB_WORKERS):
+    """
+        Fork *processes* workers that each serve *backend* from their own
+        CompletionServer, accepting from the shared *listener*, and return 
+        their pids.  Use a backend whose data readers never write to, such
+        as a FrozenTrie: its pages stay shared between the workers, where
+        the refcounts of a Trie's nodes would soon copy them into each one.
+    """
+    pids = []
+    for _ in xrange(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                CompletionServer(backend, workers=workers,
+                                 listener=listener).serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    return pids
+
+def stop_workers(pids):
+    """  Terminate the workers started by fork_workers and wait for them  """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+def frozen_backend(trie):
+    """
+        TrieBackend over a FrozenTrie snapshot of *trie*, mmapped from a file
+        that is unlinked once open
+    """
+    fd, path = tempfile.mkstemp(suffix='.trie')
+    os.close(fd)
+    try:
+        trie.freeze(path)
+        return TrieBackend(frozentrie.FrozenTrie.open(path))
+    finally:
+        os.remove(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve completions over TCP")
+    parser.add_argument("data", nargs="?") # Training file, Brown if not given
+    parser.add_argument("-db", action="store_true") # Query the database
+    parser.add_argument("-db_path", default=persist.DB_PATH)
+    parser.add_argument("-lazy", action="store_true") # Load db nodes on demand
+    parser.add_argument("-max_nodes", type=int, default=lazytrie.MAX_NODES)
+    parser.add_argument("-frozen", metavar="PATH") # Serve from a snapshot
+    parser.add_argument("-host", default='127.0.0.1')
+    parser.add_argument("-port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-workers", type=int, default=DB_WORKERS)
+    parser.add_argument("-processes", type=int, default=1) # Forked servers
+    args = parser.parse_args()
+
+    if args.db and args.lazy:
+        backend = LazyTrieBackend(lazytrie.LazyTrie(
+            persist.TrieStore(args.db_path), args.max_nodes))
+    elif args.db:
+        backend = StoreBackend(persist.TrieStore(args.db_path))
+    elif args.frozen:
+        backend = TrieBackend(frozentrie.FrozenTrie.open(args.frozen))
+    elif args.data:
+        with open(args.data, "r") as f:
+            backend = TrieBackend(autocomplete.create_trie(f.read()))
+    else:
+        backend = TrieBackend(autocomplete.create_trie())
+    print "Serving completions on %s:%d" % (args.host, args.port)
+    if args.processes > 1:
+        if not args.db and not args.frozen: # Share one flat copy of the trie
+            backend = frozen_backend(backend.trie)
+        pids = fork_workers(backend, listen(args.host, args.port),
+                            args.processes, args.workers)
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            stop_workers(pids)
+        return
+    server = CompletionServer(backend, args.host, args.port, args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+import autocomplete
+import persist
+
+
+class WriteTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = persist.TrieStore(os.path.join(self.tmp_dir, 'trie.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def stored_counts(self):
+        cursor = self.store.connection().cursor()
+        cursor.execute("""SELECT word, count FROM Trie WHERE count != 0""")
+        return dict(cursor.fetchall())
+
+    def test_rewrite_is_idempotent(self):
+        trie = autocomplete.Trie({'the': 3, 'then': 2, 'cat': 1})
+        self.assertTrue(self.store.write_trie(trie))
+        self.assertTrue(self.store.write_trie(trie))
+        self.assertEqual(self.stored_counts(), {'the': 3, 'then': 2, 'cat': 1})
+
+    def test_keeps_db_only_prefix_words(self):
+        self.store.add_vocabulary({'the': 5, 'then': 2, 'cat': 3})
+        self.assertTrue(self.store.write_trie(
+            autocomplete.Trie({'then': 4, 'dog': 1})))
+        self.assertEqual(self.stored_counts(),
+                         {'the': 5, 'then': 4, 'cat': 3, 'dog': 1})
+        self.assertEqual(self.store.most_common_words('th'),
+                         [['the', 5], ['then', 4]])
+
+    def test_sync_after_write(self):
+        trie = autocomplete.Trie({'the': 3, 'then': 2})
+        self.store.write_trie(trie)
+        trie.record_selection('the', -3)
+        trie.record_selection('dog', 2)
+        self.assertEqual(self.store.sync_trie(trie), 2)
+        self.assertEqual(self.stored_counts(), {'then': 2, 'dog': 2})
+        self.assertEqual(self.store.sync_trie(trie), 0)
+
+    def test_failed_write_keeps_changes(self):
+        trie = autocomplete.Trie({'the': 3})
+        trie.record_selection('dog', 5)
+        def fail(cursor, word, count):
+            raise persist.sqlite3.OperationalError("disk I/O error")
+        set_word_count = persist._set_word_count
+        persist._set_word_count = fail
+        try:
+            self.assertRaises(persist.sqlite3.OperationalError,
+                              self.store.write_trie, trie)
+        finally:
+            persist._set_word_count = set_word_count
+        self.assertEqual(self.stored_counts(), {})
+        self.assertEqual(trie.take_changes(), {'dog': 5})
+
+    def test_write_and_sync_key_words_alike(self):
+        trie = autocomplete.Trie({u'na\xefve': 2, 'nave': 1})
+        self.store.write_trie(trie)
+        self.assertEqual(self.stored_counts(), {'nave': 3})
+        trie.record_selection(u'na\xefve', 1)
+        self.store.sync_trie(trie)
+        self.store.write_trie(trie)
+        self.assertEqual(self.stored_counts(), {'nave': 4})
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = persist.TrieStore(os.path.join(self.tmp_dir, 'trie.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bulk_load_while_queue_is_open(self):
+        queue = persist.WriteBehindQueue(self.store)
+        queue.add_word('the', 2)
+        self.assertTrue(queue.flush())
+        self.store.add_vocabulary({'the': 1, 'cat': 1})
+        self.assertTrue(queue.close())
+        self.assertEqual(self.store.most_common_words('', 2),
+                         [['the', 3], ['cat', 1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
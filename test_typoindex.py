@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+import autocomplete
+
+
+class TypoIndexTest(unittest.TestCase):
+
+    def assertMatchesWalk(self, trie, word, k=5):
+        walk = trie.local_word_probs(word, k)
+        trie.build_typo_index()
+        try:
+            lookup = trie.local_word_probs(word, k)
+        finally:
+            trie.typo_index = None
+        def ranked(word_probs): # Ties in any order
+            return sorted((-round(prob, 12), w) for w, prob in word_probs)
+        self.assertEqual(ranked(lookup), ranked(walk))
+
+    def test_long_word_substitution(self):
+        trie = autocomplete.Trie({'qwertasdf': 1, 'qwertassf': 1,
+                                  'qwertasdd': 1, 'qwertasxf': 1,
+                                  'qwertasdg': 1, 'qwertzsdf': 50})
+        self.assertMatchesWalk(trie, 'qwertasdf')
+
+    def test_long_words(self):
+        trie = autocomplete.Trie({'keyboards': 4, 'keyboarding': 2,
+                                  'keybpards': 1, 'jeyboards': 9,
+                                  'keyboardist': 3, 'monitors': 5})
+        for word in ('keyboards', 'keybosrds', 'keyboardinf', 'jeyboardist'):
+            self.assertMatchesWalk(trie, word, 3)
+
+    def test_rebuilds_unreadable_file(self):
+        trie = autocomplete.Trie({'keyboards': 4, 'monitors': 5})
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'typos.idx')
+            trie.build_typo_index(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 2])
+            trie.build_typo_index(path)
+            self.assertTrue(trie.typo_index.matches(trie))
+            with open(path, 'wb') as f:
+                f.write('not a pickle')
+            trie.build_typo_index(path)
+            self.assertTrue(trie.typo_index.matches(trie))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
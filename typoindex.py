@@ -0,0 +1,190 @@
+import cPickle
+import hashlib
+import heapq
+import numpy
+from itertools import count
+
+FORMAT_VERSION = 2
+
+
+def deletes(string, max_edits):
+    """  Return the set of strings made by deleting up to *max_edits* letters  """
+    variants = set([string])
+    frontier = variants
+    for _ in xrange(max_edits):
+        frontier = set(variant[:i] + variant[i+1:]
+                       for variant in frontier for i in xrange(len(variant)))
+        variants |= frontier
+    return variants
+
+def fingerprint(trie):
+    """
+        Digest of the words and counts in *trie*, identifying the vocabulary
+        an index was built from
+    """
+    digest = hashlib.sha1()
+    for word, word_counts in sorted(trie.words_from_node(trie.root)):
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        digest.update('%s %d\n' % (word, word_counts))
+    return digest.hexdigest()
+
+def ranked_extensions(node, prefix, k, penalty_factor):
+    """
+        Return the *k* best (word, count) pairs under *node*, which spells
+        *prefix*, ranked by count divided by *penalty_factor* for every
+        letter the word adds to *prefix*
+    """
+    tiebreak = count()
+    queue = [(-node.max_count, next(tiebreak), prefix, node, 0)]
+    ranked_words = []
+    while queue and len(ranked_words) < k:
+        _, _, word, node, word_counts = heapq.heappop(queue)
+        if node is None:
+            ranked_words.append((word, word_counts))
+            continue
+        penalty = float(penalty_factor)**(len(prefix)-len(word))
+        if node.word_counts:
+            heapq.heappush(queue, (-penalty*node.word_counts, next(tiebreak),
+                                   word, None, node.word_counts))
+        for letter, child in node.children.iteritems():
+            if child.max_count:
+                heapq.heappush(queue, (-penalty*child.max_count/penalty_factor,
+                                       next(tiebreak), word + letter, child, 0))
+    return ranked_words
+
+
+class TypoIndex(object):
+    """
+        Symmetric delete index for typo correction, in the style of SymSpell.
+        Every prefix of up to *prefix_length* letters in a Trie is stored
+        under each string made by deleting up to *max_edits* of its letters,
+        next to its best completions.  A typed word with up to *max_edits*
+        substituted letters shares one of those delete strings with the
+        prefix that was meant, so finding corrections takes a few hash
+        lookups rather than a walk of the trie.  Candidates are scored with
+        the Trie's keyboard model exactly as in Trie.local_word_probs.
+
+        The index is a snapshot: rebuild it after counts change.  It keeps
+        the fingerprint of the Trie it was built from, see matches.
+    """
+
+    def __init__(self, max_edits=2, prefix_length=7, per_prefix=10,
+                 penalty_factor=10, total_words=0):
+        self.max_edits = max_edits
+        self.prefix_length = prefix_length
+        self.per_prefix = per_prefix # Completions kept for every prefix
+        self.penalty_factor = penalty_factor # Penalty for each extra letter
+        self.total_words = total_words
+        self.fingerprint = None # fingerprint of the Trie it was built from
+        self.prefixes = {} # length -> delete string -> prefixes of that length
+        self.completions = {} # prefix -> its best (word, count) pairs
+
+    @classmethod
+    def build(cls, trie, max_edits=2, prefix_length=7, per_prefix=10):
+        """  Index the prefixes of the words in *trie*, a Trie instance  """
+        index = cls(max_edits, prefix_length, per_prefix,
+                    trie.EXTRA_LET_PEN_FACTOR, trie.total_words)
+        index.fingerprint = fingerprint(trie)
+        explore = [(trie.root, "")]
+        while explore:
+            node, prefix = explore.pop()
+            if prefix:
+                index.completions[prefix] = tuple(ranked_extensions(
+                    node, prefix, per_prefix, index.penalty_factor))
+                same_length = index.prefixes.setdefault(len(prefix), {})
+                for variant in deletes(prefix, max_edits):
+                    same_length.setdefault(variant, []).append(prefix)
+            if len(prefix) < prefix_length:
+                for letter, child in node.children.iteritems():
+                    if child.max_count:
+                        explore.append((child, prefix + letter))
+        for same_length in index.prefixes.itervalues():
+            for variant, variant_prefixes in same_length.iteritems():
+                same_length[variant] = tuple(variant_prefixes)
+        return index
+
+    def matches(self, trie, max_edits=2, prefix_length=7, per_prefix=10):
+        """
+            Whether the index is what build would make from *trie* with the
+            same arguments, so a saved one can be used in its place
+        """
+        return ((self.max_edits, self.prefix_length, self.per_prefix,
+                 self.penalty_factor, self.total_words) ==
+                (max_edits, prefix_length, per_prefix,
+                 trie.EXTRA_LET_PEN_FACTOR, trie.total_words) and
+                self.fingerprint == fingerprint(trie))
+
+    def candidate_prefixes(self, typed):
+        """
+            Return the indexed prefixes as long as *typed* that differ from it
+            by at most *max_edits* substitutions
+        """
+        same_length = self.prefixes.get(len(typed), {})
+        candidates = set()
+        for variant in deletes(typed, self.max_edits):
+            candidates.update(same_length.get(variant, ()))
+        return candidates
+
+    def lookup(self, word, keyboard, k=5):
+        """
+            Find the *k* words most likely meant when *word* was typed, as a
+            list of [word, prob] pairs sorted by probability.  Candidate
+            prefixes are scored in one batch by *keyboard*, a
+            keyboard.KeyboardModel.  Letters typed past *prefix_length* are 
+            scored against the completions stored for the prefix rather than
+            searched for.
+        """
+        if not word or not self.total_words:
+            return []
+        typed = word[:self.prefix_length]
+        candidates = list(self.candidate_prefixes(typed))
+        prefix_probs = numpy.exp(keyboard.score(typed, candidates))
+        total_words = float(self.total_words)
+        # Best probability the letters typed past the prefix can have
+        rest_bound = keyboard.max_prob**(len(word)-len(typed))
+        word_probs = {}
+        kth_best = 0
+        for i in numpy.argsort(-prefix_probs):
+            prob = prefix_probs[i]
+            if not prob:
+                break
+            prefix = candidates[i]
+            completions = self.completions[prefix]
+            if not completions:
+                continue
+            best_word, best_counts = completions[0]
+            if prob*float(self.penalty_factor)**(len(word)-len(best_word))* \
+                    best_counts/total_words*rest_bound <= kth_best:
+                continue # Nothing under this prefix can make the top k
+            for completion, word_counts in completions:
+                if len(completion) < len(word):
+                    continue
+                completion_prob = prob*float(self.penalty_factor)**(
+                    len(word)-len(completion))*word_counts/total_words
+                if len(word) > len(typed):
+                    completion_prob *= keyboard.prob(word[len(typed):], 
+                        completion[len(typed):len(word)])
+                if completion_prob > word_probs.get(completion, 0):
+                    word_probs[completion] = completion_prob
+            if len(word_probs) >= k:
+                kth_best = heapq.nlargest(k, word_probs.itervalues())[-1]
+        ranked = heapq.nlargest(k, word_probs.iteritems(), key=lambda x: x[1])
+        return [[completion, float(prob)] for completion, prob in ranked]
+
+    def save(self, path):
+        """  Serialize the index to *path*  """
+        with open(path, 'wb') as f:
+            cPickle.dump((FORMAT_VERSION, self.__dict__), f,
+                         cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """  Load an index written by save from *path*  """
+        with open(path, 'rb') as f:
+            version, state = cPickle.load(f)
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported typo index version: %r" % (version,))
+        index = cls()
+        index.__dict__.update(state)
+        return index